@@ -21,26 +21,13 @@ import logging
 import random
 
 import thriftpy2
-from sqlmodel import Session, create_engine, select
 from thriftpy2.contrib.aio.rpc import TAsyncSocket
 
-from thriftoy.common.message import TMessage
+from thriftoy.common.message import get_records_from_sqlite
 
 echo_thrift = thriftpy2.load("../echo/echo.thrift", module_name="echo_thrift")
 
 
-def get_message_from_sqlite(path: str, method: str, limit: int) -> list[TMessage]:
-    engine = create_engine(path)
-    messages = []
-    with Session(engine) as session:
-        statement = select(TMessage).where(TMessage.method == method).limit(limit)
-        results = session.exec(statement)
-        for result in results:
-            messages.append(result)
-    print(f"load thrift message size: {len(messages)}")
-    return messages
-
-
 async def consumer(messages, host, port):
     socket = TAsyncSocket(host=host, port=port, connect_timeout=10000000, socket_timeout=10000000)
     await socket.open()
@@ -87,9 +74,8 @@ async def main():
     hosts = ["0.0.0.0", "0.0.0.0"]
     ports = [6000, 6000]
     tasks = []
-    messages = get_message_from_sqlite(
-        "sqlite:///../../thrift-dump/data.db", method="echo", limit=100
-    )
+    messages = get_records_from_sqlite("../../thrift-dump/data.db", method="echo", limit=100)
+    print(f"load thrift message size: {len(messages)}")
     # tasks.append(asyncio.create_task(producer(queue)))
     for index in range(1000):
         tasks.append(
@@ -21,28 +21,15 @@ import logging
 from concurrent.futures import ThreadPoolExecutor
 
 import thriftpy2
-from sqlmodel import Session, create_engine, select
 from thriftpy2.protocol.binary import TBinaryProtocolFactory
 from thriftpy2.rpc import TSocket, make_client
 from thriftpy2.transport.framed import TFramedTransportFactory
 
-from thriftoy.common.message import TMessage
+from thriftoy.common.message import get_records_from_sqlite
 
 echo_thrift = thriftpy2.load("../echo/echo.thrift", module_name="echo_thrift")
 
 
-def get_message_from_sqlite(path: str, method: str, limit: int) -> list[TMessage]:
-    engine = create_engine(path)
-    messages = []
-    with Session(engine) as session:
-        statement = select(TMessage).where(TMessage.method == method).limit(limit)
-        results = session.exec(statement)
-        for result in results:
-            messages.append(result)
-    print(f"load thrift message size: {len(messages)}")
-    return messages
-
-
 def run_send_idl_message(
     host,
     port,
@@ -64,7 +51,7 @@ def run_send_idl_message(
     while True:
         idx = (idx + 1) % len(messages)
         message = messages[idx]
-        args = message.extract_args(service, method=method)
+        args = message.extract_args(service)
         try:
             client.__getattr__(method)(*args)
         except Exception as e:
@@ -89,9 +76,8 @@ def main():
     hosts = ["0.0.0.0", "0.0.0.0"]
     ports = [6000, 6000]
     pool = ThreadPoolExecutor(1000)
-    messages = get_message_from_sqlite(
-        "sqlite:///../../thrift-dump/data.db", method="echo", limit=100
-    )
+    messages = get_records_from_sqlite("../../thrift-dump/data.db", method="echo", limit=100)
+    print(f"load thrift message size: {len(messages)}")
     for idx in range(200):
         pool.submit(run_send_raw_message, hosts[idx % 2], ports[idx % 2], messages)
     pool.shutdown(wait=True)
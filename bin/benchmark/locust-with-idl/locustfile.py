@@ -19,26 +19,13 @@
 
 import locust
 import thriftpy2
-from sqlmodel import Session, create_engine, select
 
 from thriftoy.benchmark.locust_user import ThriftUser
-from thriftoy.common.message import TMessage
+from thriftoy.common.message import get_records_from_sqlite
 
 echo_thrift = thriftpy2.load("../echo/echo.thrift", module_name="echo_thrift")
 
 
-def get_message_from_sqlite(path: str, method: str, limit: int) -> list[TMessage]:
-    engine = create_engine(path)
-    messages = []
-    with Session(engine) as session:
-        statement = select(TMessage).where(TMessage.method == method).limit(limit)
-        results = session.exec(statement)
-        for result in results:
-            messages.append(result)
-    print(f"load thrift message size: {len(messages)}")
-    return messages
-
-
 class MyThriftUser(ThriftUser):
     wait_time = locust.between(0.009, 0.011)
 
@@ -46,9 +33,7 @@ class MyThriftUser(ThriftUser):
     method = "echo"
     remote_hosts = ["0.0.0.0", "0.0.0.0"]
     remote_ports = [6000, 6000]
-    messages = get_message_from_sqlite(
-        "sqlite:///../../thrift-dump/data.db", method="echo", limit=100
-    )
+    messages = get_records_from_sqlite("../../thrift-dump/data.db", method="echo", limit=100)
 
     def __init__(self, environment):
         super().__init__(environment)
@@ -63,8 +48,6 @@ class MyThriftUser(ThriftUser):
 
 
 if __name__ == "__main__":
-    messages = get_message_from_sqlite(
-        "sqlite:///../../thrift-dump/data.db", method="echo", limit=100
-    )
+    messages = get_records_from_sqlite("../../thrift-dump/data.db", method="echo", limit=100)
     args = messages[2].extract_args(echo_thrift.EchoService)
     print(args.req.params)
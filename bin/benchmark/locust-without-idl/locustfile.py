@@ -18,22 +18,9 @@
 
 
 import locust
-from sqlmodel import Session, create_engine, select
 
 from thriftoy.benchmark.locust_user import ThriftWithoutIDLUser
-from thriftoy.common.message import TMessage
-
-
-def get_message_from_sqlite(path: str) -> list[TMessage]:
-    engine = create_engine(path)
-    messages = []
-    with Session(engine) as session:
-        statement = select(TMessage)
-        results = session.exec(statement)
-        for result in results:
-            messages.append(result)
-    print(f"load size: {len(messages)}")
-    return messages
+from thriftoy.common.message import get_records_from_sqlite
 
 
 class MyThriftUser(ThriftWithoutIDLUser):
@@ -43,7 +30,7 @@ class MyThriftUser(ThriftWithoutIDLUser):
     remote_hosts = ["0.0.0.0", "0.0.0.0"]
     remote_ports = [6000, 6000]
     local_bound_hosts = ["0.0.0.0", "0.0.0.0"]
-    messages = get_message_from_sqlite("sqlite:///../../thrift-dump/data.db")
+    messages = get_records_from_sqlite("../../thrift-dump/data.db")
 
     def __init__(self, environment):
         super().__init__(environment)
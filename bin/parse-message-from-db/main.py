@@ -33,7 +33,7 @@ echo_thrift = thriftpy2.load("../echo/echo.thrift", module_name="echo_thrift")
 
 @app.command()
 def send(db_path: Path, host: str = "0.0.0.0", port: int = 6000):
-    messages = get_message_from_sqlite(f"sqlite:///{db_path}", limit=100)
+    messages = get_message_from_sqlite(db_path.as_posix(), limit=100)
     client = make_simple_client(host=host, port=port, service=echo_thrift.EchoService)
 
     for message in messages[0:1]:
@@ -43,7 +43,7 @@ def send(db_path: Path, host: str = "0.0.0.0", port: int = 6000):
 
 @app.command()
 def save(db_path: Path, save_dir: Path):
-    messages = get_message_from_sqlite(f"sqlite:///{db_path}", limit=100)
+    messages = get_message_from_sqlite(db_path.as_posix(), limit=100)
     for message in messages[0:1]:
         args = message.extract_args(echo_thrift.EchoService)
         data = struct_to_json(args)
@@ -0,0 +1,166 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import random
+import socket
+import threading
+import time
+
+import pytest
+import thriftpy2
+from thriftpy2.protocol.exc import TProtocolException
+
+from thriftoy.common.async_server import TAsyncMessageExtractedServer
+from thriftoy.common.message import serialize_method_args
+from thriftoy.common.message_filter import TMessageFilter
+from thriftoy.common.message_framer import TMessageFramer
+from thriftoy.common.types import ProtocolType, TransportType
+
+framer_thrift = thriftpy2.load_fp(
+    io.StringIO(
+        """
+service Service {
+    string keep(1: string param, 2: list<i64> values),
+    string drop(1: string param),
+}
+"""
+    ),
+    module_name="framer_thrift",
+)
+
+KINDS = [(transport_type, protocol_type) for transport_type in TransportType for protocol_type in ProtocolType]
+
+
+def make_messages(transport_type, protocol_type, count: int, seed: int = 0) -> list[tuple[str, int, bytes]]:
+    rand = random.Random(seed)
+    messages = []
+    for seqid in range(count):
+        size = rand.choice([0, 1, 100, 5000, 70000])
+        if rand.random() < 0.3:
+            method, args = "drop", framer_thrift.Service.drop_args(param="d" * size)
+        else:
+            method, args = "keep", framer_thrift.Service.keep_args(param="k" * size, values=list(range(size % 97)))
+        data = serialize_method_args(args, method, 1, seqid, transport_type=transport_type, protocol_type=protocol_type)
+        messages.append((method, seqid, data))
+    return messages
+
+
+def random_chunks(data: bytes, rand: random.Random):
+    offset = 0
+    while offset < len(data):
+        size = rand.choice([1, 2, 3, 7, 64, 4096, 100000])
+        yield data[offset : offset + size]
+        offset += size
+
+
+@pytest.mark.parametrize("transport_type, protocol_type", KINDS)
+def test_random_chunks(transport_type, protocol_type):
+    messages = make_messages(transport_type, protocol_type, 50)
+    framer = TMessageFramer(transport_type, protocol_type)
+    framed = []
+    for chunk in random_chunks(b"".join(data for _, _, data in messages), random.Random(1)):
+        framed += framer.feed(chunk)
+    assert [(m.method, m.seqid, m.data) for m in framed] == messages
+    assert all(m.type == 1 for m in framed)
+    assert framer.pending_size == 0
+
+
+@pytest.mark.parametrize("transport_type, protocol_type", KINDS)
+def test_accept(transport_type, protocol_type):
+    messages = make_messages(transport_type, protocol_type, 50, seed=2)
+    framer = TMessageFramer(transport_type, protocol_type, accept=lambda method: method != "drop")
+    framed = []
+    for chunk in random_chunks(b"".join(data for _, _, data in messages), random.Random(3)):
+        framed += framer.feed(chunk)
+    assert [(m.method, m.seqid, m.data) for m in framed] == [m for m in messages if m[0] != "drop"]
+    assert framer.pending_size == 0
+
+
+@pytest.mark.parametrize("protocol_type", list(ProtocolType))
+def test_oversized_frame(protocol_type):
+    framer = TMessageFramer(TransportType.FRAMED, protocol_type, max_message_size=1000)
+    args = framer_thrift.Service.keep_args(param="x", values=[])
+    small = serialize_method_args(args, "keep", 1, 1, transport_type=TransportType.FRAMED, protocol_type=protocol_type)
+    assert len(framer.feed(small)) == 1
+    # rejected from the frame size alone, before the payload arrives
+    with pytest.raises(TProtocolException):
+        framer.feed((2000).to_bytes(4, "big"))
+
+    framer = TMessageFramer(TransportType.FRAMED, protocol_type, max_message_size=1000)
+    with pytest.raises(TProtocolException):
+        framer.feed((-1).to_bytes(4, "big", signed=True))
+
+
+@pytest.mark.parametrize("protocol_type", list(ProtocolType))
+def test_oversized_buffered_message(protocol_type):
+    framer = TMessageFramer(TransportType.BUFFERED, protocol_type, max_message_size=1000)
+    args = framer_thrift.Service.keep_args(param="x" * 5000, values=[])
+    data = serialize_method_args(args, "keep", 1, 1, transport_type=TransportType.BUFFERED, protocol_type=protocol_type)
+    with pytest.raises(TProtocolException):
+        for chunk in random_chunks(data, random.Random(5)):
+            framer.feed(chunk)
+
+
+class CollectingProcessor:
+    def __init__(self, message_filter: TMessageFilter) -> None:
+        self.message_filter = message_filter
+        self.messages = []
+
+    def on_connection_open(self):
+        pass
+
+    def on_connection_close(self):
+        pass
+
+    def handle_message(self, message, iprot, oprot):
+        self.messages.append(message)
+
+
+@pytest.mark.parametrize("transport_type, protocol_type", KINDS)
+def test_async_server_filters(transport_type, protocol_type):
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    processor = CollectingProcessor(TMessageFilter(deny_methods=["drop"]))
+    server = TAsyncMessageExtractedServer(
+        processor, "127.0.0.1", port, protocol_type=protocol_type, transport_type=transport_type
+    )
+    thread = threading.Thread(target=server.serve, daemon=True)
+    thread.start()
+
+    messages = make_messages(transport_type, protocol_type, 30, seed=6)
+    kept = [m for m in messages if m[0] != "drop"]
+    deadline = time.monotonic() + 5
+    while True:
+        try:
+            client = socket.create_connection(("127.0.0.1", port))
+            break
+        except ConnectionRefusedError:
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+    with client:
+        for chunk in random_chunks(b"".join(data for _, _, data in messages), random.Random(7)):
+            client.sendall(chunk)
+        while len(processor.messages) < len(kept) and time.monotonic() < deadline:
+            time.sleep(0.05)
+    server.close()
+    thread.join(5)
+
+    assert [(m.method, m.seqid, m.data) for m in processor.messages] == kept
+    assert processor.message_filter.dropped_size == len(messages) - len(kept)
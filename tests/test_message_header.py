@@ -0,0 +1,174 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import random
+
+import pytest
+import thriftpy2
+from thriftpy2.protocol.binary import TBinaryProtocol
+from thriftpy2.protocol.compact import TCompactProtocol
+from thriftpy2.thrift import TMessageType
+from thriftpy2.transport import TMemoryBuffer, TTransportException
+
+from thriftoy.common.message_header import (
+    TMessageScanner,
+    cut_seqid,
+    parse_message_header,
+    paste_seqid,
+    skip_message,
+)
+from thriftoy.common.types import ProtocolType, TransportType
+
+header_thrift = thriftpy2.load_fp(
+    io.StringIO(
+        """
+struct Item {
+    1: i32 id,
+    2: string name,
+}
+
+service Service {
+    void call(
+        1: bool flag,
+        2: byte small,
+        3: i16 short_value,
+        4: i32 value,
+        5: i64 long_value,
+        6: double ratio,
+        7: string text,
+        8: binary blob,
+        9: list<Item> items,
+        10: set<i64> ids,
+        11: map<string, list<double>> series,
+        12: Item item,
+        13: list<string> empty,
+    )
+}
+"""
+    ),
+    module_name="header_thrift",
+)
+
+PROTOCOLS = {
+    "binary-strict": (ProtocolType.BINARY, lambda trans: TBinaryProtocol(trans, strict_write=True)),
+    "binary-non-strict": (ProtocolType.BINARY, lambda trans: TBinaryProtocol(trans, strict_write=False)),
+    "compact": (ProtocolType.COMPACT, TCompactProtocol),
+}
+
+
+def make_args(size: int):
+    Item = header_thrift.Item
+    return header_thrift.Service.call_args(
+        flag=True,
+        small=-7,
+        short_value=-300,
+        value=1 << 20,
+        long_value=-(1 << 40),
+        ratio=0.25,
+        text="é" * size,
+        blob=bytes(range(256)) * size,
+        items=[Item(id=i, name=f"item {i}") for i in range(size)],
+        ids={-1, 0, 1 << 33},
+        series={"a": [1.0, 2.0], "b": []},
+        item=Item(id=-1),
+        empty=[],
+    )
+
+
+def serialize(protocol: str, seqid: int = 1, size: int = 3, method: str = "call") -> bytes:
+    trans = TMemoryBuffer()
+    proto = PROTOCOLS[protocol][1](trans)
+    proto.write_message_begin(method, TMessageType.CALL, seqid)
+    make_args(size).write(proto)
+    proto.write_message_end()
+    return trans.getvalue()
+
+
+@pytest.mark.parametrize("protocol", PROTOCOLS)
+def test_skip_message(protocol):
+    protocol_type = PROTOCOLS[protocol][0]
+    first, second = serialize(protocol, seqid=1), serialize(protocol, seqid=2, size=5)
+    buf = first + second
+    assert parse_message_header(buf, protocol_type)[:3] == ("call", TMessageType.CALL, 1)
+    assert skip_message(buf, protocol_type) == len(first)
+    assert skip_message(buf, protocol_type, len(first)) == len(buf)
+    for end in range(len(first)):
+        with pytest.raises(TTransportException):
+            skip_message(first[:end], protocol_type)
+
+
+@pytest.mark.parametrize("protocol", PROTOCOLS)
+def test_scanner_byte_by_byte(protocol):
+    protocol_type = PROTOCOLS[protocol][0]
+    message = serialize(protocol)
+    buf = bytearray(b"garbage")
+    scanner = TMessageScanner(protocol_type, len(buf))
+    for byte in message[:-1]:
+        buf.append(byte)
+        assert scanner.feed(buf) == -1
+    buf.append(message[-1])
+    assert scanner.feed(buf) == len(buf)
+
+
+@pytest.mark.parametrize("protocol", PROTOCOLS)
+def test_scanner_random_chunks(protocol):
+    protocol_type = PROTOCOLS[protocol][0]
+    rand = random.Random(protocol)
+    messages = [serialize(protocol, seqid=i, size=rand.randrange(0, 50)) for i in range(20)]
+    data = b"".join(messages)
+    buf = bytearray()
+    ends = []
+    scanner = TMessageScanner(protocol_type)
+    while data:
+        size = rand.randrange(1, 200)
+        buf += data[:size]
+        data = data[size:]
+        while (end := scanner.feed(buf)) != -1:
+            ends.append(end)
+            scanner = TMessageScanner(protocol_type, end)
+    offsets = [0]
+    for message in messages:
+        offsets.append(offsets[-1] + len(message))
+    assert ends == offsets[1:]
+
+
+@pytest.mark.parametrize("transport_type", list(TransportType))
+@pytest.mark.parametrize("protocol", PROTOCOLS)
+def test_cut_paste_seqid(protocol, transport_type):
+    protocol_type = PROTOCOLS[protocol][0]
+    seqids = [0, 1, 127, 128, 1 << 20, (1 << 31) - 1]
+    if protocol_type == ProtocolType.BINARY:
+        seqids.append(-5)
+    cuts = set()
+    for seqid in seqids:
+        data = serialize(protocol, seqid=seqid)
+        if transport_type == TransportType.FRAMED:
+            data = len(data).to_bytes(4, "big") + data
+        cut = cut_seqid(data, seqid, transport_type, protocol_type)
+        assert cut is not None
+        assert paste_seqid(cut, seqid, transport_type, protocol_type) == data
+        cuts.add(cut)
+    # messages differing only by seqid share one cut
+    assert len(cuts) == 1
+
+
+def test_cut_seqid_rejects_unrestorable():
+    data = serialize("compact", seqid=5)
+    # the seqid in the message is not the one it would be pasted back with
+    assert cut_seqid(data, 6, TransportType.BUFFERED, ProtocolType.COMPACT) is None
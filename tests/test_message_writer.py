@@ -0,0 +1,70 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import struct
+
+import sqlalchemy
+import sqlmodel
+
+from thriftoy.common.message import TConnection, TMessage, TMessageBlob, iter_messages
+from thriftoy.common.message_writer import CAPTURE_TABLES, TMessageBatchWriter
+
+
+def framed_binary_message(method: str, seqid: int) -> bytes:
+    name = method.encode()
+    body = struct.pack("!iI", -2147418111, len(name)) + name + struct.pack("!i", seqid) + b"\x00"
+    return struct.pack("!i", len(body)) + body
+
+
+def make_message(seqid: int) -> TMessage:
+    return TMessage(
+        method="ping",
+        type=1,
+        seqid=seqid,
+        data=framed_binary_message("ping", seqid),
+        connection=TConnection(from_host="127.0.0.1", from_port=4000, listen_host="0.0.0.0", listen_port=7048),
+    )
+
+
+def test_failed_commit_does_not_leave_dangling_blob_ids(tmp_path):
+    engine = sqlmodel.create_engine(f"sqlite:///{tmp_path / 'capture.db'}")
+    sqlmodel.SQLModel.metadata.create_all(engine, tables=CAPTURE_TABLES)
+    writer = TMessageBatchWriter(engine, batch_size=1, linger_ms=0, dedup=True)
+    failures = [RuntimeError("disk full")]
+
+    @sqlalchemy.event.listens_for(sqlmodel.Session, "before_commit")
+    def fail_once(session):
+        if failures:
+            raise failures.pop()
+
+    try:
+        writer.put(make_message(1))
+        while writer.dropped_size == 0:
+            writer.thread.join(0.01)
+        writer.put(make_message(2))
+    finally:
+        writer.close()
+        sqlalchemy.event.remove(sqlmodel.Session, "before_commit", fail_once)
+
+    assert writer.dropped_size == 1
+    assert writer.written_size == 1
+    messages = list(iter_messages(engine))
+    assert [message.seqid for message in messages] == [2]
+    assert messages[0].data == framed_binary_message("ping", 2)
+    assert messages[0].from_port == 4000
+    with sqlmodel.Session(engine) as session:
+        assert len(session.exec(sqlmodel.select(TMessageBlob)).all()) == 1
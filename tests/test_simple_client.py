@@ -0,0 +1,81 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import io
+import threading
+
+import pytest
+import thriftpy2
+from thriftpy2.protocol import TBinaryProtocolFactory
+from thriftpy2.protocol.binary import TBinaryProtocolFactory as TPyBinaryProtocolFactory
+from thriftpy2.rpc import TThreadedServer
+from thriftpy2.thrift import TProcessor
+from thriftpy2.transport import TBufferedTransportFactory, TFramedTransportFactory, TServerSocket
+from thriftpy2.transport.framed import TFramedTransportFactory as TPyFramedTransportFactory
+
+from thriftoy.client.simple_client import make_simple_client_pool
+
+echo_thrift = thriftpy2.load_fp(
+    io.StringIO("service EchoService { string echo(1: string param) }"), module_name="echo_thrift"
+)
+
+
+class EchoHandler:
+    def echo(self, param):
+        return param
+
+
+@pytest.mark.parametrize(
+    "proto_factory, trans_factory",
+    [
+        # the cython ones thriftpy2 gives by default, as used by the locust users
+        (TBinaryProtocolFactory, TFramedTransportFactory),
+        (TBinaryProtocolFactory, TBufferedTransportFactory),
+        (TPyBinaryProtocolFactory, TPyFramedTransportFactory),
+    ],
+)
+def test_pool_reuses_idle_client(proto_factory, trans_factory):
+    server_socket = TServerSocket(host="127.0.0.1", port=0)
+    server = TThreadedServer(
+        TProcessor(echo_thrift.EchoService, EchoHandler()),
+        server_socket,
+        trans_factory(),
+        proto_factory(),
+        daemon=True,
+    )
+    # listen here to learn the port, serve would listen again
+    server_socket.listen()
+    server.trans.listen = lambda: None
+    threading.Thread(target=server.serve, daemon=True).start()
+    port = server_socket.sock.getsockname()[1]
+
+    pool = make_simple_client_pool(
+        "127.0.0.1",
+        port,
+        echo_thrift.EchoService,
+        proto_factory=proto_factory(),
+        trans_factory=trans_factory(),
+    )
+    for i in range(5):
+        with pool.borrow() as client:
+            assert client.call("echo", echo_thrift.EchoService.echo_args(param=str(i))) == str(i)
+    stats = pool.stats()
+    pool.close()
+    server.close()
+    assert stats.creations == 1
+    assert stats.hits == 4
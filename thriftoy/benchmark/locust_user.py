@@ -15,19 +15,59 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import logging
 import random
 import time
+from collections.abc import Callable
 
 import locust
 from thriftpy2.protocol import TBinaryProtocolFactory
 from thriftpy2.transport import TFramedTransportFactory
 
-from ..client.simple_client import make_simple_client
-from ..common.socket import TSimpleSocket
+from ..client.simple_client import make_simple_client_pool
+from ..common.socket import make_socket_pool
+from ..utils.object_pool import ObjectPool
+
+# (user class, remote index) -> pool shared by the users of the class, and how many use it
+shared_pools: dict[tuple[type, int], ObjectPool] = {}
+pool_users: dict[tuple[type, int], int] = {}
+
+
+def join_pool(key: tuple[type, int], creator: Callable[[], ObjectPool]) -> ObjectPool:
+    """
+    The pool for `key`, keeping one idle connection per user so that, as every user waits for its
+    reply, connections are reused instead of being opened and closed on each request.
+    """
+    pool = shared_pools.get(key)
+    if pool is None:
+        pool = shared_pools[key] = creator()
+    pool_users[key] = pool_users.get(key, 0) + 1
+    pool.resize(pool_users[key])
+    return pool
+
+
+def leave_pool(key: tuple[type, int]):
+    pool = shared_pools.get(key)
+    if pool is not None:
+        pool_users[key] -= 1
+        pool.resize(pool_users[key])
+
+
+@locust.events.test_stop.add_listener
+def close_pools(**kwargs):
+    for pool in shared_pools.values():
+        pool.close()
+    shared_pools.clear()
+    pool_users.clear()
 
 
 class ThriftWithoutIDLUser(locust.User):
+    """
+    Replay raw messages, over connections pooled per remote host and shared by all users of the class.
+    Subclasses overriding `on_stop` call it to release their share of the pool.
+    """
+
     abstract = True
 
     remote_hosts: list[str]
@@ -37,38 +77,36 @@ class ThriftWithoutIDLUser(locust.User):
 
     def __init__(self, environment):
         super().__init__(environment)
-        self.socket = self.create_socket()
-        self.socket.open()
+        self.pool_key = (type(self), random.randint(0, len(self.remote_hosts) - 1))
+        self.socket_pool = join_pool(self.pool_key, functools.partial(self.make_socket_pool, self.pool_key[1]))
 
-    def create_socket(self):
-        idx = random.randint(0, len(self.remote_hosts) - 1)
+    @classmethod
+    def make_socket_pool(cls, idx: int) -> ObjectPool:
         local_host = None
-        if len(self.local_bound_hosts) == len(self.remote_hosts):
-            local_host = self.local_bound_hosts[idx]
-        tsocket = TSimpleSocket(
+        if len(cls.local_bound_hosts) == len(cls.remote_hosts):
+            local_host = cls.local_bound_hosts[idx]
+        return make_socket_pool(
+            cls.remote_hosts[idx],
+            cls.remote_ports[idx],
+            pool_size=1,
             connect_timeout=30000,
             socket_timeout=30000,
-            remote_host=self.remote_hosts[idx],
-            remote_port=self.remote_ports[idx],
             local_host=local_host,
         )
-        return tsocket
 
     def on_stop(self):
-        return self.socket.close()
+        leave_pool(self.pool_key)
 
     def request(self, method, data):
         start_perf_counter = time.perf_counter()
         exception = None
         try:
-            self.socket.write(data)
-            TFramedTransportFactory().get_transport(self.socket).read(4)
-            # self.socket.close()
+            # a failed connection is discarded, the next request gets a new one
+            with self.socket_pool.borrow() as tsocket:
+                tsocket.write(data)
+                TFramedTransportFactory().get_transport(tsocket).read(4)
         except Exception as e:
-            self.socket.close()
             logging.error("write failed: %s", e)
-            self.socket = self.create_socket()
-            self.socket.open()
             exception = e
 
         self.environment.events.request.fire(
@@ -83,6 +121,11 @@ class ThriftWithoutIDLUser(locust.User):
 
 
 class ThriftUser(locust.User):
+    """
+    Call `service` through clients pooled per remote host and shared by all users of the class.
+    Subclasses overriding `on_stop` call it to release their share of the pool.
+    """
+
     abstract = True
 
     remote_hosts: list[str]
@@ -95,16 +138,24 @@ class ThriftUser(locust.User):
 
     def __init__(self, environment):
         super().__init__(environment)
-        idx = random.randint(0, len(self.remote_hosts) - 1)
-        self.client = make_simple_client(
-            service=self.service,
-            host=self.remote_hosts[idx],
-            port=self.remote_ports[idx],
-            timeout=self.timeout,
-            proto_factory=self.protocol_factory(),
-            trans_factory=self.transport_factory(),
+        self.pool_key = (type(self), random.randint(0, len(self.remote_hosts) - 1))
+        self.client_pool = join_pool(self.pool_key, functools.partial(self.make_client_pool, self.pool_key[1]))
+
+    @classmethod
+    def make_client_pool(cls, idx: int) -> ObjectPool:
+        return make_simple_client_pool(
+            service=cls.service,
+            host=cls.remote_hosts[idx],
+            port=cls.remote_ports[idx],
+            timeout=cls.timeout,
+            proto_factory=cls.protocol_factory(),
+            trans_factory=cls.transport_factory(),
+            pool_size=1,
         )
 
+    def on_stop(self):
+        leave_pool(self.pool_key)
+
     def request(self, method: str, args):
         start_perf_counter = time.perf_counter()
         exception = None
@@ -112,7 +163,8 @@ class ThriftUser(locust.User):
         try:
             # res = self.client.__getattr__(method)(*args, **kwargs)
             logging.debug("ThriftUser::request method:%s", method)
-            res = self.client.call(method, args)
+            with self.client_pool.borrow() as client:
+                res = client.call(method, args)
         except Exception as e:
             exception = e
         self.environment.events.request.fire(
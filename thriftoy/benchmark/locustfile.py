@@ -22,7 +22,7 @@ import os
 import locust
 
 from thriftoy.benchmark.locust_user import ThriftWithoutIDLUser
-from thriftoy.common.message import get_message_from_sqlite
+from thriftoy.common.message import get_records_from_sqlite
 
 dbpath = os.environ.get("DB_PATH")
 if dbpath is None:
@@ -36,10 +36,7 @@ print(f"port: {ports}")
 print(f"load_req_size: {load_req_size}")
 print(f"dbpath: {dbpath}")
 
-messages = get_message_from_sqlite(
-    dbpath,
-    limit=load_req_size,
-)
+messages = get_records_from_sqlite(dbpath, limit=load_req_size)
 
 
 class MyThriftUser(ThriftWithoutIDLUser):
@@ -16,11 +16,14 @@
 # limitations under the License.
 
 
+import functools
+
 from thriftpy2.protocol.binary import TBinaryProtocolFactory
 from thriftpy2.rpc import TClient
 from thriftpy2.transport.framed import TFramedTransportFactory
 
-from ..common.socket import TSimpleSocket
+from ..common.socket import TSimpleSocket, find_socket, is_socket_open
+from ..utils.object_pool import ObjectPool
 
 
 class TSimpleClient(TClient):
@@ -54,3 +57,31 @@ def make_simple_client(
     protocol = proto_factory.get_protocol(transport)
     transport.open()
     return TSimpleClient(service, protocol)
+
+
+def is_simple_client_open(client: TSimpleClient) -> bool:
+    return is_socket_open(find_socket(client._iprot.trans))
+
+
+def make_simple_client_pool(
+    host,
+    port,
+    service,
+    proto_factory=TBinaryProtocolFactory(),  # noqa: B008
+    trans_factory=TFramedTransportFactory(),  # noqa: B008
+    socket_family=None,
+    timeout=3000,
+    pool_size: int = 8,
+    **pool_options,
+) -> ObjectPool:
+    """
+    Pool of connected `TSimpleClient`, validated on checkout, see `ObjectPool` for `pool_options`.
+    """
+    return ObjectPool(
+        functools.partial(
+            make_simple_client, host, port, service, proto_factory, trans_factory, socket_family, timeout
+        ),
+        pool_size,
+        validator=is_simple_client_open,
+        **pool_options,
+    )
@@ -15,28 +15,43 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+from collections import deque
+
 from thriftpy2.protocol.binary import TBinaryProtocolFactory
 from thriftpy2.rpc import TClient, TSocket
 from thriftpy2.thrift import TApplicationException, TMessageType
+from thriftpy2.transport import TMemoryBuffer
 from thriftpy2.transport.framed import TFramedTransportFactory
 
-from ..common.memory_wrapped_transport import TMemoryWrappedTransportFactory
+from ..common.memory_wrapped_transport import TMemoryWrappedTransport, TMemoryWrappedTransportFactory
 from ..common.message import TMessage
-from ..common.message_extracted_processor import EmptyThriftStruct
-from ..common.socket import TSimpleSocket
-from ..common.types import TransportType
+from ..common.message_framer import TMessageFramer, TRawMessage
+from ..common.socket import TSimpleSocket, find_socket, is_socket_open
+from ..common.types import ProtocolType, TransportType
+from ..utils.object_pool import ObjectPool
 
 
 class TUnServicedClient(TClient):
     """
     Enhance `TClient` to perform RPC call using serilized data direactly.
+    Replies are framed by `TMessageFramer`, so pipelined calls can be received one by one.
     """
 
+    READ_CHUNK_SIZE = 65536
+
     def __init__(self, iprot, oprot=None):
         super().__init__(None, iprot, oprot)
+        if isinstance(iprot.trans, TMemoryWrappedTransport):
+            transport_type = iprot.trans.transport_type
+        else:
+            transport_type = TransportType.create(iprot.trans)
+        self.protocol_type = ProtocolType.create(iprot)
+        self.framer = TMessageFramer(transport_type, self.protocol_type)
+        self.received: deque[TRawMessage] = deque()
 
     def call(self, message: TMessage, recv_message: bool = False) -> TMessage | None:
-        socket: TSocket = self._oprot.trans._trans._trans
+        socket: TSocket = self._iprot.trans._trans
         socket.write(message.data)
         socket.flush()
 
@@ -46,16 +61,17 @@ class TUnServicedClient(TClient):
             return None
 
     def recv_message(self) -> TMessage:
-        fname, mtype, rseqid = self._iprot.read_message_begin()
+        socket: TSocket = self._iprot.trans._trans
+        while not self.received:
+            self.received.extend(self.framer.feed(socket.read(self.READ_CHUNK_SIZE)))
+        fname, mtype, rseqid, data = self.received.popleft()
         if mtype == TMessageType.EXCEPTION:
+            header_offset = 4 if self.framer.transport_type == TransportType.FRAMED else 0
+            prot = self.protocol_type.get_factory().get_protocol(TMemoryBuffer(data[header_offset:]))
+            prot.read_message_begin()
             x = TApplicationException()
-            x.read(self._iprot)
-            self._iprot.read_message_end()
+            x.read(prot)
             raise x
-        self._iprot.read_struct(EmptyThriftStruct())
-        self._iprot.read_message_end()
-        data = self._iprot.getvalue()
-        self._iprot.clearbuffer()
         return TMessage(method=fname, data=data, seqid=rseqid, type=mtype)
 
 
@@ -72,8 +88,34 @@ def make_unserivced_client(
     oprotocol = proto_factory.get_protocol(otransport)
     otransport.open()
 
-    itransport = TMemoryWrappedTransportFactory(TransportType.create(otransport)).get_transport(
-        tsocket
-    )
+    itransport = TMemoryWrappedTransportFactory(TransportType.create(trans_factory)).get_transport(tsocket)
     iprotocol = proto_factory.get_protocol(itransport)
     return TUnServicedClient(oprot=oprotocol, iprot=iprotocol)
+
+
+def is_unserviced_client_open(client: TUnServicedClient) -> bool:
+    # replies received but not read would be returned to the next borrower
+    if client.received or client.framer.pending_size:
+        return False
+    return is_socket_open(find_socket(client._iprot.trans))
+
+
+def make_unserivced_client_pool(
+    host,
+    port,
+    proto_factory=TBinaryProtocolFactory(),  # noqa: B008
+    trans_factory=TFramedTransportFactory(),  # noqa: B008
+    socket_family=None,
+    timeout=3000,
+    pool_size: int = 8,
+    **pool_options,
+) -> ObjectPool:
+    """
+    Pool of connected `TUnServicedClient`, validated on checkout, see `ObjectPool` for `pool_options`.
+    """
+    return ObjectPool(
+        functools.partial(make_unserivced_client, host, port, proto_factory, trans_factory, socket_family, timeout),
+        pool_size,
+        validator=is_unserviced_client_open,
+        **pool_options,
+    )
@@ -0,0 +1,131 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import logging
+import time
+
+from .message import TConnection, TMessage
+from .message_extracted_processor import TMessageExtractedProcessor
+from .message_framer import TMessageFramer
+from .types import ProtocolType, TransportType
+
+
+class TAsyncMessageExtractedServer:
+    """
+    Serve a `TMessageExtractedProcessor` on one asyncio event loop.
+    Messages are framed here and handed to `processor.handle_message` as raw `TMessage`,
+    so thousands of persistent connections cost no OS threads.
+    """
+
+    READ_CHUNK_SIZE = 65536
+
+    def __init__(
+        self,
+        processor: TMessageExtractedProcessor,
+        host: str,
+        port: int,
+        protocol_type: ProtocolType = ProtocolType.BINARY,
+        transport_type: TransportType = TransportType.FRAMED,
+        reuse_port: bool = False,
+    ) -> None:
+        self.processor = processor
+        self.host = host
+        self.port = port
+        self.protocol_type = protocol_type
+        self.transport_type = transport_type
+        self.reuse_port = reuse_port
+        self.connections: dict[asyncio.Task, asyncio.StreamWriter] = {}
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.stopped: asyncio.Event | None = None
+
+    def serve(self):
+        asyncio.run(self.serve_async())
+
+    async def serve_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_server(self.handle, self.host, self.port, reuse_port=self.reuse_port or None)
+        async with server:
+            await self.stopped.wait()
+            server.close()
+            tasks = list(self.connections)
+            for writer in self.connections.values():
+                writer.close()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        if self.loop is None or self.stopped is None:
+            return
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self.stopped.set()
+        else:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        self.processor.on_connection_open()
+        from_host, from_port = writer.get_extra_info("peername")[:2]
+        listen_host, listen_port = writer.get_extra_info("sockname")[:2]
+        connection = TConnection(
+            from_host=from_host,
+            from_port=from_port,
+            listen_host=listen_host,
+            listen_port=listen_port,
+        )
+        try:
+            async for method, type, seqid, data in self.read_messages(reader):
+                if self.stopped.is_set():
+                    break
+                message = TMessage(
+                    method=method,
+                    type=type,
+                    seqid=seqid,
+                    data=data,
+                    connection=connection,
+                    transport_type=self.transport_type,
+                    protocol_type=self.protocol_type,
+                    timestamp=time.time_ns(),
+                )
+                self.processor.handle_message(message, None, None)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.exception("TAsyncMessageExtractedServer: %s", e)
+        finally:
+            self.connections.pop(task, None)
+            self.processor.on_connection_close()
+            writer.close()
+
+    def accept(self, method: str) -> bool:
+        message_filter = self.processor.message_filter
+        return message_filter is None or message_filter.accept(method)
+
+    async def read_messages(self, reader: asyncio.StreamReader):
+        # rejected messages are dropped by the framer before their payload is copied
+        framer = TMessageFramer(self.transport_type, self.protocol_type, accept=self.accept)
+        while True:
+            chunk = await reader.read(self.READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            for message in framer.feed(chunk):
+                yield message
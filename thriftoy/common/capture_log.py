@@ -0,0 +1,270 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import mmap
+import struct
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+from .message import TConnection, TMessage
+from .types import ProtocolType, TransportType
+
+PROTOCOL_TYPES = list(ProtocolType)
+TRANSPORT_TYPES = list(TransportType)
+
+# header_size, data_size
+RECORD_PREFIX = struct.Struct("!II")
+# timestamp(ns), seqid, type, protocol, transport, from_port, listen_port, method/from_host/listen_host size
+RECORD_HEADER = struct.Struct("!qibBBHHHBB")
+
+
+class CaptureLogRecord(NamedTuple):
+    method: str
+    type: int
+    seqid: int
+    timestamp: int
+    from_host: str
+    from_port: int
+    listen_host: str
+    listen_port: int
+    protocol_type: ProtocolType
+    transport_type: TransportType
+    data: memoryview
+
+    def to_message(self) -> TMessage:
+        return TMessage(
+            method=self.method,
+            type=self.type,
+            seqid=self.seqid,
+            connection=TConnection(
+                from_host=self.from_host,
+                from_port=self.from_port,
+                listen_host=self.listen_host,
+                listen_port=self.listen_port,
+            ),
+            timestamp=self.timestamp,
+            protocol_type=self.protocol_type,
+            transport_type=self.transport_type,
+            data=bytes(self.data),
+        )
+
+
+def pack_record(message: TMessage, timestamp: int) -> bytes:
+    method = message.method.encode("utf-8")
+    from_host = (message.from_host or "").encode("utf-8")
+    listen_host = (message.listen_host or "").encode("utf-8")
+    header = RECORD_HEADER.pack(
+        timestamp,
+        message.seqid,
+        message.type,
+        PROTOCOL_TYPES.index(ProtocolType(message.protocol_type)),
+        TRANSPORT_TYPES.index(TransportType(message.transport_type)),
+        message.from_port or 0,
+        message.listen_port or 0,
+        len(method),
+        len(from_host),
+        len(listen_host),
+    )
+    header_size = len(header) + len(method) + len(from_host) + len(listen_host)
+    return b"".join(
+        (RECORD_PREFIX.pack(header_size, len(message.data)), header, method, from_host, listen_host, message.data)
+    )
+
+
+def unpack_record(buf: memoryview, offset: int) -> tuple[CaptureLogRecord, int]:
+    """
+    Decode the record at `offset`, return it with the offset of the next record.
+    `data` of the record is a view on `buf`.
+    """
+    header_size, data_size = RECORD_PREFIX.unpack_from(buf, offset)
+    offset += RECORD_PREFIX.size
+    end = offset + header_size + data_size
+    if end > len(buf):
+        raise EOFError(f"truncated record at {offset - RECORD_PREFIX.size}")
+    (
+        timestamp,
+        seqid,
+        type,
+        protocol,
+        transport,
+        from_port,
+        listen_port,
+        method_size,
+        from_host_size,
+        listen_host_size,
+    ) = RECORD_HEADER.unpack_from(buf, offset)
+    pos = offset + RECORD_HEADER.size
+    method = str(buf[pos : pos + method_size], "utf-8")
+    pos += method_size
+    from_host = str(buf[pos : pos + from_host_size], "utf-8")
+    pos += from_host_size
+    listen_host = str(buf[pos : pos + listen_host_size], "utf-8")
+    record = CaptureLogRecord(
+        method=method,
+        type=type,
+        seqid=seqid,
+        timestamp=timestamp,
+        from_host=from_host,
+        from_port=from_port,
+        listen_host=listen_host,
+        listen_port=listen_port,
+        protocol_type=PROTOCOL_TYPES[protocol],
+        transport_type=TRANSPORT_TYPES[transport],
+        data=buf[offset + header_size : end],
+    )
+    return record, end
+
+
+class CaptureLogWriter:
+    """
+    Append-only capture log split into segments of at most `segment_size` bytes.
+    Every `segment-N.log` has a sidecar `segment-N.idx` holding the uint64 offset of each record.
+    """
+
+    def __init__(self, directory: Path, segment_size: int = 256 * 1024 * 1024) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.segment_id = len(list_segments(self.directory))
+        self.log_file = None
+        self.idx_file = None
+        self.offset = 0
+
+    def open_segment(self):
+        self.close()
+        path = segment_path(self.directory, self.segment_id)
+        self.log_file = open(path, "ab")
+        self.idx_file = open(path.with_suffix(".idx"), "ab")
+        self.offset = self.log_file.tell()
+        self.segment_id += 1
+
+    def append(self, messages: list[TMessage]):
+        now = time.time_ns()
+        records = []
+        offsets = array.array("Q")
+        for message in messages:
+            if self.log_file is None or self.offset >= self.segment_size:
+                self.flush(records, offsets)
+                records, offsets = [], array.array("Q")
+                self.open_segment()
+            record = pack_record(message, message.timestamp or now)
+            offsets.append(self.offset)
+            records.append(record)
+            self.offset += len(record)
+        self.flush(records, offsets)
+
+    def flush(self, records: list[bytes], offsets: array.array):
+        if not records:
+            return
+        self.log_file.write(b"".join(records))
+        self.log_file.flush()
+        self.idx_file.write(offsets.tobytes())
+        self.idx_file.flush()
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.idx_file.close()
+            self.log_file = None
+            self.idx_file = None
+
+
+class CaptureLogReader:
+    """
+    Iterate a capture log directory by mmap-ing its segments.
+    The `data` of every record is a memoryview into the mapping and stays valid until `close`.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = Path(directory)
+        self.segments = list_segments(self.directory)
+        self.mmaps: list[tuple[mmap.mmap, memoryview]] = []
+        # segment mappings and indexes for `record_at`, kept until `close`
+        self.views: dict[Path, memoryview] = {}
+        self.indexes: dict[Path, array.array] = {}
+
+    def __len__(self):
+        return sum(len(self.read_index(path)) for path in self.segments)
+
+    def __iter__(self):
+        for path in self.segments:
+            yield from self.iter_segment(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_index(self, path: Path) -> array.array:
+        offsets = array.array("Q")
+        offsets.frombytes(path.with_suffix(".idx").read_bytes())
+        return offsets
+
+    def map_segment(self, path: Path) -> memoryview:
+        with open(path, "rb") as f:
+            if f.seek(0, 2) == 0:
+                return memoryview(b"")
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(buf)
+        self.mmaps.append((buf, view))
+        return view
+
+    def iter_segment(self, path: Path):
+        buf = self.map_segment(path)
+        offset = 0
+        while offset + RECORD_PREFIX.size <= len(buf):
+            try:
+                record, offset = unpack_record(buf, offset)
+            except EOFError:
+                # tail of a segment which is still being written
+                return
+            yield record
+
+    def record_at(self, path: Path, index: int) -> CaptureLogRecord:
+        offsets = self.indexes.get(path)
+        if offsets is None or index >= len(offsets):
+            # first access, or the segment grew since it was mapped
+            offsets = self.indexes[path] = self.read_index(path)
+            self.views.pop(path, None)
+        view = self.views.get(path)
+        if view is None:
+            view = self.views[path] = self.map_segment(path)
+        record, _ = unpack_record(view, offsets[index])
+        return record
+
+    def close(self):
+        for buf, view in self.mmaps:
+            view.release()
+            try:
+                buf.close()
+            except BufferError:
+                # records still referenced outside, the mapping is dropped with them
+                pass
+        self.mmaps = []
+        self.views = {}
+        self.indexes = {}
+
+
+def segment_path(directory: Path, segment_id: int) -> Path:
+    return directory / f"segment-{segment_id:08d}.log"
+
+
+def list_segments(directory: Path) -> list[Path]:
+    return sorted(Path(directory).glob("segment-*.log"))
@@ -16,11 +16,100 @@
 # limitations under the License.
 
 
+import collections
+import functools
+import hashlib
+import struct
+import sys
+import threading
+import weakref
+from collections.abc import Callable, Iterable, Iterator, Sequence
+from typing import NamedTuple
+
+import sqlalchemy
 import sqlmodel
+from sqlalchemy.orm.attributes import set_committed_value
 from thriftpy2.protocol.json import struct_to_json
 from thriftpy2.transport.memory import TMemoryBuffer
 
-from .types import ProtocolType, TransportType
+from .message_header import paste_seqid
+from .payload_codec import decompress_payload, dictionary_checksum
+from .types import PayloadCodec, ProtocolType, TransportType
+
+try:
+    from thriftpy2.protocol.cybin import TCyBinaryProtocolFactory
+    from thriftpy2.transport.memory.cymemory import TCyMemoryBuffer
+except ImportError:  # thriftpy2 built without its cython extensions
+    TCyBinaryProtocolFactory = TCyMemoryBuffer = None
+
+
+class TMessageCodec:
+    """
+    Reusable context to decode/encode method args of one (transport_type, protocol_type).
+    The frame size of framed transport is handled here, so the protocol runs straight on a memory buffer,
+    with the cython binary protocol when thriftpy2 has it.
+    Not thread-safe, use `get_message_codec` to get the calling thread's instance.
+    """
+
+    def __init__(self, transport_type: TransportType, protocol_type: ProtocolType) -> None:
+        if transport_type not in (TransportType.FRAMED, TransportType.BUFFERED):
+            raise NotImplementedError(f"Unsupported transport type {transport_type}")
+        self.transport_type = transport_type
+        self.protocol_type = protocol_type
+        self.header_size = 4 if transport_type == TransportType.FRAMED else 0
+        # the cython buffer reads faster for every protocol, but is only faster to write with the cython protocol
+        if protocol_type == ProtocolType.BINARY and TCyBinaryProtocolFactory is not None:
+            self.protocol_factory = TCyBinaryProtocolFactory()
+            self.rbuf, self.wbuf = TCyMemoryBuffer(), TCyMemoryBuffer()
+        elif TCyMemoryBuffer is not None:
+            self.protocol_factory = protocol_type.get_factory()
+            self.rbuf, self.wbuf = TCyMemoryBuffer(), TMemoryBuffer()
+        else:
+            self.protocol_factory = protocol_type.get_factory()
+            self.rbuf, self.wbuf = TMemoryBuffer(), TMemoryBuffer()
+        self.iprot = self.protocol_factory.get_protocol(self.rbuf)
+        self.oprot = self.protocol_factory.get_protocol(self.wbuf)
+
+    def extract_args(self, data: bytes, service, method: str):
+        self.rbuf.setvalue(bytes(data[self.header_size :]))
+        try:
+            self.iprot.read_message_begin()
+            args = getattr(service, f"{method}_args")()
+            args.read(self.iprot)
+            self.iprot.read_message_end()
+        except Exception:
+            # compact protocol keeps per-struct state, don't reuse it after a broken read
+            self.iprot = self.protocol_factory.get_protocol(self.rbuf)
+            raise
+        return args
+
+    def serialize_args(self, args, method: str, ttype: int, seqid: int) -> bytes:
+        self.wbuf.setvalue(b"")
+        try:
+            self.oprot.write_message_begin(method, ttype, seqid)
+            args.write(self.oprot)
+            self.oprot.write_message_end()
+        except Exception:
+            self.oprot = self.protocol_factory.get_protocol(self.wbuf)
+            raise
+        body = self.wbuf.getvalue()
+        if self.header_size:
+            return struct.pack("!i", len(body)) + body
+        return body
+
+
+_codecs = threading.local()
+
+
+def get_message_codec(transport_type: TransportType, protocol_type: ProtocolType) -> TMessageCodec:
+    codecs: dict[tuple[TransportType, ProtocolType], TMessageCodec] | None = getattr(_codecs, "codecs", None)
+    if codecs is None:
+        codecs = _codecs.codecs = {}
+    key = (TransportType(transport_type), ProtocolType(protocol_type))
+    codec = codecs.get(key)
+    if codec is None:
+        codec = codecs[key] = TMessageCodec(*key)
+    return codec
 
 
 def extract_method_args(
@@ -30,13 +119,7 @@ def extract_method_args(
     transport_type=TransportType.FRAMED,
     protocol_type=ProtocolType.BINARY,
 ):
-    trans = transport_type.get_factory().get_transport(TMemoryBuffer(value=data))
-    prot = protocol_type.get_factory().get_protocol(trans)
-    prot.read_message_begin()
-    args = getattr(service, f"{method}_args")()
-    args.read(prot)
-    prot.read_message_end()
-    return args
+    return get_message_codec(transport_type, protocol_type).extract_args(data, service, method)
 
 
 def serialize_method_args(
@@ -47,32 +130,117 @@ def serialize_method_args(
     transport_type=TransportType.FRAMED,
     protocol_type=ProtocolType.BINARY,
 ) -> bytes:
-    membuf = TMemoryBuffer()
-    trans = transport_type.get_factory().get_transport(membuf)
-    prot = protocol_type.get_factory().get_protocol(trans)
-    prot.write_message_begin(method, ttype, seqid)
-    args.write(prot)
-    prot.write_message_end()
-    prot.trans.flush()
-    return membuf.getvalue()
+    return get_message_codec(transport_type, protocol_type).serialize_args(args, method, ttype, seqid)
+
+
+def extract_messages_args(messages: Iterable["TMessage"], service) -> Iterator:
+    """
+    Lazily decode the args of each message, reusing one codec per (transport_type, protocol_type).
+    """
+    codec = None
+    for message in messages:
+        if (
+            codec is None
+            or codec.transport_type != message.transport_type
+            or codec.protocol_type != message.protocol_type
+        ):
+            codec = get_message_codec(message.transport_type, message.protocol_type)
+        yield codec.extract_args(message.data, service, message.method)
+
+
+def serialize_messages_args(messages: Iterable["TMessage"], args_list: Iterable) -> Iterator[bytes]:
+    """
+    Lazily encode each args with the method/type/seqid and codec of the message paired with it.
+    """
+    codec = None
+    for message, args in zip(messages, args_list, strict=True):
+        if (
+            codec is None
+            or codec.transport_type != message.transport_type
+            or codec.protocol_type != message.protocol_type
+        ):
+            codec = get_message_codec(message.transport_type, message.protocol_type)
+        yield codec.serialize_args(args, message.method, message.type, message.seqid)
+
+
+class TConnection(sqlmodel.SQLModel, table=True):
+    """
+    A captured client connection, shared by all `TMessage` received on it.
+    """
+
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+
+    from_host: str = ""
+    from_port: int = 0
+    listen_host: str = ""
+    listen_port: int = 0
+
+    def key(self) -> tuple[str, int, str, int]:
+        return (self.from_host, self.from_port, self.listen_host, self.listen_port)
+
+
+class TMessageBlob(sqlmodel.SQLModel, table=True):
+    """
+    A payload shared by captured messages that are byte-identical except for their seqid.
+    `data` is the message without frame size and seqid (see `cut_seqid`), `hash` its digest.
+    """
+
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+    hash: bytes = sqlmodel.Field(sa_column_kwargs={"unique": True})
+    data: bytes
+    repeat_count: int = 0  # messages referencing this blob
+
+
+def message_blob_hash(cut: bytes) -> bytes:
+    return hashlib.blake2b(cut, digest_size=16).digest()
+
+
+class TPayloadDictionary(sqlmodel.SQLModel, table=True):
+    """
+    A zlib preset dictionary payloads of the capture are compressed with, found by the checksum
+    zlib records in the compressed stream.
+    """
+
+    id: int | None = sqlmodel.Field(default=None, primary_key=True)
+    checksum: int = sqlmodel.Field(sa_column_kwargs={"unique": True})
+    data: bytes
 
 
 class TMessage(sqlmodel.SQLModel, table=True):
     id: int | None = sqlmodel.Field(default=None, primary_key=True)
 
-    from_host: str | None = ""
-    from_port: int | None = 0
-    listen_host: str | None = ""
-    listen_port: int | None = 0
-    # timestamp: int = 0
+    connection_id: int | None = sqlmodel.Field(default=None, foreign_key="tconnection.id")
+    # many-to-one, joined so peer properties stay readable after the session is closed
+    connection: TConnection | None = sqlmodel.Relationship(sa_relationship_kwargs={"lazy": "joined"})
+    timestamp: int = 0  # capture time in ns
+    # deduplicated payload, `data` is then stored empty and restored on load
+    blob_id: int | None = sqlmodel.Field(default=None, foreign_key="tmessageblob.id")
+    blob: TMessageBlob | None = sqlmodel.Relationship(sa_relationship_kwargs={"lazy": "joined"})
 
     method: str
     type: int  # TODO: to enum?
     seqid: int  # TODO: int32 or int64
     protocol_type: ProtocolType = ProtocolType.BINARY
     transport_type: TransportType = TransportType.FRAMED
+    codec: PayloadCodec = PayloadCodec.RAW  # how `data` is stored, restored on load
     data: bytes
 
+    @property
+    def from_host(self) -> str:
+        return self.connection.from_host if self.connection else ""
+
+    @property
+    def from_port(self) -> int:
+        return self.connection.from_port if self.connection else 0
+
+    @property
+    def listen_host(self) -> str:
+        return self.connection.listen_host if self.connection else ""
+
+    @property
+    def listen_port(self) -> int:
+        return self.connection.listen_port if self.connection else 0
+
     def to_json_str(self, service):
         args = self.extract_args(service)
         return struct_to_json(args.req)
@@ -108,17 +276,336 @@ class TMessage(sqlmodel.SQLModel, table=True):
         )
 
 
+@sqlalchemy.event.listens_for(TMessage, "load", propagate=True)
+def restore_message_data(message: TMessage, context):
+    blob = message.__dict__.get("blob")
+    if blob is not None:
+        data = paste_seqid(blob.data, message.seqid, message.transport_type, message.protocol_type)
+        set_committed_value(message, "data", data)
+    elif message.codec != PayloadCodec.RAW:
+        lookup = functools.partial(get_payload_dictionary, context.session)
+        set_committed_value(message, "data", decompress_payload(message.data, message.codec, lookup))
+
+
+payload_dictionaries: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_payload_dictionary(session: sqlmodel.Session, checksum: int) -> bytes:
+    """
+    Preset dictionaries are read once per engine, and again when a checksum is missing.
+    """
+    engine = session.get_bind()
+    dictionaries = payload_dictionaries.get(engine)
+    if dictionaries is None or checksum not in dictionaries:
+        statement = sqlmodel.select(TPayloadDictionary.checksum, TPayloadDictionary.data)
+        dictionaries = payload_dictionaries[engine] = dict(session.exec(statement).all())
+    if checksum not in dictionaries:
+        raise ValueError(f"Missing payload dictionary {checksum:#010x}")
+    return dictionaries[checksum]
+
+
+def save_payload_dictionary(session: sqlmodel.Session, dictionary: bytes):
+    checksum = dictionary_checksum(dictionary)
+    statement = sqlmodel.select(TPayloadDictionary.id).where(TPayloadDictionary.checksum == checksum)
+    if session.exec(statement).first() is None:
+        session.add(TPayloadDictionary(checksum=checksum, data=dictionary))
+
+
+class TMessageRecord(NamedTuple):
+    """
+    Compact immutable copy of the wire fields of a `TMessage`, for holding large corpora in memory.
+    A record costs a small tuple on top of its payload, instead of a full SQLModel instance.
+    """
+
+    method: str
+    type: int
+    seqid: int
+    protocol_type: ProtocolType
+    transport_type: TransportType
+    data: bytes
+
+    @classmethod
+    def from_message(cls, message: TMessage) -> "TMessageRecord":
+        return cls(
+            sys.intern(message.method),
+            message.type,
+            message.seqid,
+            ProtocolType(message.protocol_type),
+            TransportType(message.transport_type),
+            message.data,
+        )
+
+    def to_message(self) -> TMessage:
+        return TMessage(
+            method=self.method,
+            type=self.type,
+            seqid=self.seqid,
+            protocol_type=self.protocol_type,
+            transport_type=self.transport_type,
+            data=self.data,
+        )
+
+    def extract_args(self, service):
+        return get_message_codec(self.transport_type, self.protocol_type).extract_args(self.data, service, self.method)
+
+    def serialize_args(self, args) -> bytes:
+        codec = get_message_codec(self.transport_type, self.protocol_type)
+        return codec.serialize_args(args, self.method, self.type, self.seqid)
+
+
+MESSAGE_INDEXES = {
+    "ix_tmessage_method": "tmessage (method)",
+    "ix_tmessage_timestamp": "tmessage (timestamp)",
+    "ix_tmessage_connection_id": "tmessage (connection_id)",
+    "ix_tconnection_peer": "tconnection (from_host, from_port)",
+}
+
+
+# columns added to tmessage since the first captures, with their DDL
+MESSAGE_ADDED_COLUMNS = {
+    "connection_id": "INTEGER REFERENCES tconnection (id)",
+    "timestamp": "INTEGER NOT NULL DEFAULT 0",
+    "blob_id": "INTEGER REFERENCES tmessageblob (id)",
+    "codec": "VARCHAR(4) NOT NULL DEFAULT 'RAW'",
+}
+# peer columns of the first captures, moved into tconnection
+MESSAGE_PEER_COLUMNS = {"from_host": "''", "from_port": "0", "listen_host": "''", "listen_port": "0"}
+
+upgraded_engines: weakref.WeakSet = weakref.WeakSet()
+
+
+def upgrade_message_schema(engine):
+    """
+    Bring older captures up to date, adding the tables and `MESSAGE_ADDED_COLUMNS` they miss
+    and moving the peer columns of the first captures into `TConnection`.
+    Checked once per engine.
+    """
+    if engine in upgraded_engines:
+        return
+    with engine.begin() as conn:
+        inspector = sqlalchemy.inspect(conn)
+        if inspector.has_table("tmessage"):
+            for table in (TConnection.__table__, TMessageBlob.__table__, TPayloadDictionary.__table__):
+                table.create(conn, checkfirst=True)
+            existing = {column["name"] for column in inspector.get_columns("tmessage")}
+            for name, ddl in MESSAGE_ADDED_COLUMNS.items():
+                if name not in existing:
+                    conn.exec_driver_sql(f"ALTER TABLE tmessage ADD COLUMN {name} {ddl}")
+            if MESSAGE_PEER_COLUMNS.keys() <= existing:
+                move_peer_columns(conn)
+    upgraded_engines.add(engine)
+
+
+def move_peer_columns(conn):
+    """
+    Give every distinct peer of a first-generation capture a `TConnection` row, point its messages
+    at it and drop the peer columns from tmessage.
+    """
+    peer = ", ".join(f"coalesce({name}, {default})" for name, default in MESSAGE_PEER_COLUMNS.items())
+    columns = ", ".join(MESSAGE_PEER_COLUMNS)
+    conn.exec_driver_sql(f"INSERT INTO tconnection ({columns}) SELECT DISTINCT {peer} FROM tmessage")
+    conn.exec_driver_sql(f"CREATE INDEX ix_tconnection_key ON tconnection ({columns})")
+    match = " AND ".join(
+        f"tconnection.{name} = coalesce(tmessage.{name}, {default})" for name, default in MESSAGE_PEER_COLUMNS.items()
+    )
+    conn.exec_driver_sql(f"UPDATE tmessage SET connection_id = (SELECT id FROM tconnection WHERE {match})")
+    conn.exec_driver_sql("DROP INDEX ix_tconnection_key")
+    for name in MESSAGE_PEER_COLUMNS:
+        conn.exec_driver_sql(f"ALTER TABLE tmessage DROP COLUMN {name}")
+
+
+checked_engines: weakref.WeakSet = weakref.WeakSet()
+
+
+def check_message_schema(engine):
+    """
+    Read-only counterpart of `upgrade_message_schema` for readers, which never write to a capture:
+    raise if it needs upgrading first. Checked once per engine.
+    """
+    if engine in checked_engines or engine in upgraded_engines:
+        return
+    inspector = sqlalchemy.inspect(engine)
+    if inspector.has_table("tmessage"):
+        existing = {column["name"] for column in inspector.get_columns("tmessage")}
+        missing = [name for name in MESSAGE_ADDED_COLUMNS if name not in existing]
+        if missing:
+            raise ValueError(
+                f"Outdated capture {engine.url.database}, tmessage lacks {', '.join(missing)}: "
+                "upgrade it with `thrift-dump upgrade` first"
+            )
+    checked_engines.add(engine)
+
+
+def create_message_indexes(engine, analyze: bool = False):
+    """
+    Indexes are built once a capture is closed instead of maintained on every insert.
+    `analyze` also refreshes the statistics sqlite uses to pick between them.
+    """
+    upgrade_message_schema(engine)
+    with engine.begin() as conn:
+        for name, columns in MESSAGE_INDEXES.items():
+            conn.exec_driver_sql(f"CREATE INDEX IF NOT EXISTS {name} ON {columns}")
+        if analyze:
+            conn.exec_driver_sql("ANALYZE")
+
+
+def message_conditions(
+    schema=TMessage,
+    method: str | Iterable[str] | None = None,
+    start_id: int | None = None,
+    end_id: int | None = None,
+    start_time: int | None = None,
+    end_time: int | None = None,
+    from_host: str | None = None,
+    from_port: int | None = None,
+) -> list:
+    """
+    WHERE clauses shared by the corpus readers, each one backed by an index of `MESSAGE_INDEXES`.
+    Ranges are half-open: [start_id, end_id), [start_time, end_time) with times in ns.
+    """
+    conditions = []
+    if isinstance(method, str):
+        conditions.append(schema.method == method)
+    elif method is not None:
+        conditions.append(schema.method.in_(list(method)))
+    if start_id is not None:
+        conditions.append(schema.id >= start_id)
+    if end_id is not None:
+        conditions.append(schema.id < end_id)
+    if start_time is not None:
+        conditions.append(schema.timestamp >= start_time)
+    if end_time is not None:
+        conditions.append(schema.timestamp < end_time)
+    if from_host is not None or from_port is not None:
+        peer = sqlmodel.select(TConnection.id)
+        if from_host is not None:
+            peer = peer.where(TConnection.from_host == from_host)
+        if from_port is not None:
+            peer = peer.where(TConnection.from_port == from_port)
+        conditions.append(schema.connection_id.in_(peer))
+    return conditions
+
+
+def iter_messages(
+    source: str | sqlalchemy.Engine,
+    columns: Sequence[str] | None = None,
+    method: str | Iterable[str] | None = None,
+    start_id: int | None = None,
+    end_id: int | None = None,
+    start_time: int | None = None,
+    end_time: int | None = None,
+    from_host: str | None = None,
+    from_port: int | None = None,
+    limit: int | None = None,
+    chunk_size: int = 1000,
+    schema=TMessage,
+) -> Iterator:
+    """
+    Stream messages of a sqlite path or engine in id order, `chunk_size` rows at a time.
+    Chunks are paged by id (keyset), each in a short session, so memory stays flat and no read
+    transaction is held between chunks.
+    Yield `schema` instances, or rows of `columns` only if given (plain values for a single column).
+    Filters are those of `message_conditions`.
+    """
+    engine = sqlmodel.create_engine(f"sqlite:///{source}") if isinstance(source, str) else source
+    check_message_schema(engine)
+    conditions = message_conditions(schema, method, start_id, end_id, start_time, end_time, from_host, from_port)
+
+    last_id = None
+    remaining = limit
+    try:
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            with sqlmodel.Session(engine) as session:
+                rows, bound = select_message_page(session, columns, conditions, size, last_id, schema)
+            yield from rows
+            if bound is None:
+                return
+            last_id = bound
+            if remaining is not None:
+                remaining -= len(rows)
+    finally:
+        if isinstance(source, str):
+            engine.dispose()
+
+
+def select_message_page(
+    session: sqlmodel.Session,
+    columns: Sequence[str] | None,
+    conditions: list,
+    size: int,
+    after_id: int | None = None,
+    schema=TMessage,
+) -> tuple[list, int | None]:
+    """
+    Fetch the `size` rows following `after_id` in id order (keyset pagination).
+    Return them with the id of the last one, or None when fewer than `size` rows were left,
+    so `columns` need not include the id.
+    """
+    entities, convert = message_entities(session, columns, schema)
+    where = conditions if after_id is None else [*conditions, schema.id > after_id]
+    bound = session.exec(sqlmodel.select(schema.id).where(*where).order_by(schema.id).offset(size - 1).limit(1)).first()
+    statement = sqlmodel.select(*entities).where(*where)
+    if bound is not None:
+        statement = statement.where(schema.id <= bound)
+    return convert(session.exec(statement.order_by(schema.id).limit(size)).all()), bound
+
+
+def message_entities(
+    session: sqlmodel.Session, columns: Sequence[str] | None, schema=TMessage
+) -> tuple[list, Callable[[list], list]]:
+    """
+    Return what to select for `columns` (whole `schema` instances if None), and a function turning
+    the selected rows into results. Deduplicated or compressed `data` is restored there, rows are
+    then namedtuples.
+    """
+    if not columns:
+        return [schema], list
+    entities = [getattr(schema, column) for column in columns]
+    if "data" not in columns or not hasattr(schema, "blob_id"):
+        return entities, list
+    blob_data = sqlmodel.select(TMessageBlob.data).where(TMessageBlob.id == schema.blob_id).scalar_subquery()
+    entities += [schema.codec, blob_data, schema.seqid, schema.transport_type, schema.protocol_type]
+    row_type = message_row_type(tuple(columns))
+    size = len(columns)
+    data_index = columns.index("data")
+    lookup = functools.partial(get_payload_dictionary, session)
+
+    def convert(rows: list) -> list:
+        results = []
+        for row in rows:
+            values = list(row[:size])
+            if row[size + 1] is not None:
+                values[data_index] = paste_seqid(*row[size + 1 :])
+            elif row[size] != PayloadCodec.RAW:
+                values[data_index] = decompress_payload(values[data_index], row[size], lookup)
+            results.append(values[0] if size == 1 else row_type(*values))
+        return results
+
+    return entities, convert
+
+
+@functools.cache
+def message_row_type(columns: tuple[str, ...]) -> type:
+    return collections.namedtuple("TMessageRow", columns)
+
+
 def get_message_from_sqlite(
     path: str, limit: int, method: str | None = None, schema=TMessage
 ) -> list[TMessage]:
-    engine = sqlmodel.create_engine(f"sqlite:///{path}")
-    messages = []
-    with sqlmodel.Session(engine) as session:
-        if method:
-            statement = sqlmodel.select(schema).where(schema.method == method).limit(limit)
-        else:
-            statement = sqlmodel.select(schema).limit(limit)
-        results = session.exec(statement)
-        for result in results:
-            messages.append(result)
-    return messages
+    return list(iter_messages(path, method=method or None, limit=limit, schema=schema))
+
+
+RECORD_COLUMNS = ("method", "type", "seqid", "protocol_type", "transport_type", "data")
+
+
+def get_records_from_sqlite(path: str, limit: int | None = None, method: str | None = None) -> list[TMessageRecord]:
+    """
+    Load messages as `TMessageRecord`, selecting only the needed columns so no ORM instance is ever built.
+    """
+    return [
+        TMessageRecord(sys.intern(name), type, seqid, protocol_type, transport_type, data)
+        for name, type, seqid, protocol_type, transport_type, data in iter_messages(
+            path, columns=RECORD_COLUMNS, method=method or None, limit=limit
+        )
+    ]
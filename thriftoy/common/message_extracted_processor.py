@@ -18,13 +18,18 @@
 import io
 import logging
 import struct
+import threading
+import time
+import weakref
 
 from thriftpy2.protocol.binary import TBinaryProtocol
 from thriftpy2.rpc import TSocket
 from thriftpy2.transport.buffered import TBufferedTransport
 from thriftpy2.transport.framed import TFramedTransport
 
-from .message import TMessage
+from .message import TConnection, TMessage
+from .message_filter import TMessageFilter
+from .message_header import TBufferedSocketReader, TFramedSocketReader, parse_message_header
 from .types import ProtocolType, TransportType
 
 
@@ -42,6 +47,10 @@ class TFramedTransportHook:
         body = self._hooked_trans._rbuf.getvalue()
         return struct.pack("!i", len(body)) + body
 
+    def skip_message(self, prot):
+        # the whole frame is already in `_rbuf`, drop the unread rest
+        self._hooked_trans._rbuf.seek(0, io.SEEK_END)
+
     def __getattr__(self, name):
         return getattr(self._hooked_trans, name)
 
@@ -51,56 +60,182 @@ class TBufferedTransportHook:
         assert isinstance(trans, TBufferedTransport)
         self._hooked_trans = trans
         self._hook_buffer_ = io.BytesIO(b"")
+        self._recording = True
 
     def get_raw_data(self):
         return self._hook_buffer_.getvalue()
 
+    def reset(self):
+        self._hook_buffer_.seek(0)
+        self._hook_buffer_.truncate()
+        self._recording = True
+
+    def skip_message(self, prot):
+        self._recording = False
+        prot.read_struct(EmptyThriftStruct())
+        prot.read_message_end()
+
     def read(self, sz: int):
         buf = self._hooked_trans.read(sz)
-        self._hook_buffer_.write(buf)
+        if self._recording:
+            self._hook_buffer_.write(buf)
         return buf
 
     def __getattr__(self, name):
         return getattr(self._hooked_trans, name)
 
 
+class TConnectionState:
+    """
+    Everything `TMessageExtractedProcessor` keeps for one connection: the peer/local addresses,
+    plus the socket reader or transport hook, all built once and reused for every message.
+    """
+
+    def __init__(self, socket: TSocket) -> None:
+        assert socket.sock is not None
+        from_host, from_port = socket.sock.getpeername()[:2]
+        listen_host, listen_port = socket.sock.getsockname()[:2]
+        self.connection = TConnection(
+            from_host=from_host,
+            from_port=from_port,
+            listen_host=listen_host,
+            listen_port=listen_port,
+        )
+        self.reader: TFramedSocketReader | TBufferedSocketReader | None = None
+        # the hook only holds a proxy of the transport it wraps, which holds the socket keying this state
+        self.hook: TFramedTransportHook | TBufferedTransportHook | None = None
+        self.hooked_trans: weakref.ref | None = None
+
+    def set_hook(self, hook_type: type, trans) -> bool:
+        """
+        Hook `trans` unless it is already, return whether a new hook was set.
+        """
+        if self.hook is not None and self.hooked_trans() is trans:
+            return False
+        self.hook = hook_type(weakref.proxy(trans))
+        self.hooked_trans = weakref.ref(trans)
+        return True
+
+
 class TMessageExtractedProcessor:
     """
     A TProcessor for unpacking a thrift message without IDL.
     Need to implement the handle_message function.
     """
 
-    def __init__(self, transport_type: TransportType) -> None:
+    def __init__(self, transport_type: TransportType, message_filter: TMessageFilter | None = None) -> None:
         self.transport_type = transport_type
-
-    def extract_message(self, prot: TBinaryProtocol) -> TMessage:
+        self.message_filter = message_filter
+        # keyed by the server side client socket, dropped along with it when the connection ends
+        self.connection_states: weakref.WeakKeyDictionary[TSocket, TConnectionState] = weakref.WeakKeyDictionary()
+        self.connection_states_lock = threading.Lock()
+
+    def extract_message(self, prot: TBinaryProtocol) -> TMessage | None:
+        """
+        Return None if the message is rejected by `message_filter`.
+        """
         origin_trans = prot.trans
+        if self.transport_type == TransportType.FRAMED and self.support_header_only(origin_trans):
+            return self.extract_framed_message(prot)
+        if self.transport_type == TransportType.BUFFERED and self.support_skip_scan(origin_trans):
+            return self.extract_buffered_message(prot)
         if self.transport_type == TransportType.FRAMED:
-            logging.debug("setup TFramedTransportHook for extract message")
-            prot.trans = TFramedTransportHook(origin_trans._trans)
             socket: TSocket = origin_trans._trans._trans
+            state = self.get_connection_state(socket)
+            if state.set_hook(TFramedTransportHook, origin_trans._trans):
+                logging.debug("setup TFramedTransportHook for extract message")
         elif self.transport_type == TransportType.BUFFERED:
-            logging.debug("setup TBufferedTransportHook for extract message")
-            prot.trans = TBufferedTransportHook(origin_trans)
             socket: TSocket = origin_trans._trans
+            state = self.get_connection_state(socket)
+            if state.set_hook(TBufferedTransportHook, origin_trans):
+                logging.debug("setup TBufferedTransportHook for extract message")
+            else:
+                state.hook.reset()
         else:
             raise NotImplementedError(f"Unsupported transport type {self.transport_type}")
+        prot.trans = state.hook
 
         method, type, seqid = prot.read_message_begin()
+        timestamp = time.time_ns()
+        if self.message_filter is not None and not self.message_filter.accept(method):
+            prot.trans.skip_message(prot)
+            prot.trans = origin_trans
+            return None
         prot.read_struct(EmptyThriftStruct())
         prot.read_message_end()
         data = prot.trans.get_raw_data()
         prot.trans = origin_trans
-        message = TMessage(method=method, type=type, seqid=seqid, data=data)
+        message = TMessage(method=method, type=type, seqid=seqid, data=data, timestamp=timestamp)
+        message.connection = state.connection
+        return message
 
-        assert socket.sock is not None
-        message.from_host, message.from_port = socket.sock.getpeername()
-        message.listen_host, message.listen_port = socket.sock.getsockname()
+    @staticmethod
+    def support_header_only(trans) -> bool:
+        # TBufferedTransport(TFramedTransport(TSocket)) without a partially consumed frame
+        framed = getattr(trans, "_trans", None)
+        return (
+            isinstance(framed, TFramedTransport)
+            and isinstance(framed._trans, TSocket)
+            and framed._rbuf.tell() == len(framed._rbuf.getbuffer())
+        )
+
+    @staticmethod
+    def support_skip_scan(trans) -> bool:
+        # TBufferedTransport(TSocket) which has not buffered anything yet
+        return (
+            isinstance(trans, TBufferedTransport)
+            and isinstance(trans._trans, TSocket)
+            and trans._rbuf.tell() == len(trans._rbuf.getbuffer())
+        )
+
+    def extract_framed_message(self, prot: TBinaryProtocol) -> TMessage | None:
+        """
+        Header-only fast path for framed transport: the frame size gives the message end,
+        so only name/type/seqid are parsed and the arguments are never walked.
+        """
+        state = self.get_connection_state(prot.trans._trans._trans)
+        if state.reader is None:
+            state.reader = TFramedSocketReader(prot.trans._trans._trans.sock)
+        frame = state.reader.read_frame()
+        timestamp = time.time_ns()
+        method, type, seqid, _ = parse_message_header(frame, ProtocolType.create(prot), 4)
+        if self.message_filter is not None and not self.message_filter.accept(method):
+            return None
+        message = TMessage(method=method, type=type, seqid=seqid, data=bytes(frame), timestamp=timestamp)
+        message.connection = state.connection
+        return message
+
+    def extract_buffered_message(self, prot: TBinaryProtocol) -> TMessage | None:
+        """
+        Skip-scan path for buffered transport: the message end is found by `skip_message`
+        on raw socket bytes, so the arguments are never decoded.
+        """
+        protocol_type = ProtocolType.create(prot)
+        state = self.get_connection_state(prot.trans._trans)
+        if state.reader is None:
+            state.reader = TBufferedSocketReader(prot.trans._trans.sock, protocol_type)
+        data = state.reader.read_message()
+        timestamp = time.time_ns()
+        method, type, seqid, _ = parse_message_header(data, protocol_type)
+        if self.message_filter is not None and not self.message_filter.accept(method):
+            return None
+        message = TMessage(method=method, type=type, seqid=seqid, data=bytes(data), timestamp=timestamp)
+        message.connection = state.connection
         return message
 
+    def get_connection_state(self, socket: TSocket) -> TConnectionState:
+        state = self.connection_states.get(socket)
+        if state is None:
+            state = TConnectionState(socket)
+            with self.connection_states_lock:
+                self.connection_states[socket] = state
+        return state
+
     def process(self, iprot: TBinaryProtocol, oprot: TBinaryProtocol):
         logging.debug("TMessageExtractedProcessor:: process iprot")
         message = self.extract_message(iprot)
+        if message is None:
+            return
         message.transport_type = self.transport_type
         message.protocol_type = ProtocolType.create(iprot)
         self.handle_message(message, iprot, oprot)
@@ -110,3 +245,9 @@ class TMessageExtractedProcessor:
 
     def handle_message(self, message: TMessage, iprot, oprot):
         pass
+
+    def on_connection_open(self):
+        pass
+
+    def on_connection_close(self):
+        pass
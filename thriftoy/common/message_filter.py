@@ -0,0 +1,118 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` messages per second with bursts up to `burst`.
+    """
+
+    def __init__(self, rate: float, burst: float | None = None) -> None:
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class TMessageFilter:
+    """
+    Decide from the method name alone whether a captured message is kept, so rejected
+    messages are dropped before their payload is copied or persisted.
+        1. `allow_methods`/`deny_methods`: method allow/deny lists.
+        2. `sample_ratios`: method -> ratio of messages kept.
+        3. `max_rates`: method -> max messages per second kept.
+    The key "*" in `sample_ratios`/`max_rates` applies to methods without their own entry.
+    """
+
+    DEFAULT = "*"
+
+    def __init__(
+        self,
+        allow_methods: list[str] | None = None,
+        deny_methods: list[str] | None = None,
+        sample_ratios: dict[str, float] | None = None,
+        max_rates: dict[str, float] | None = None,
+    ) -> None:
+        self.allow_methods = set(allow_methods) if allow_methods else None
+        self.deny_methods = set(deny_methods or [])
+        self.sample_ratios = sample_ratios or {}
+        self.max_rates = max_rates or {}
+        self.buckets: dict[str, TokenBucket] = {}
+        self.buckets_lock = threading.Lock()
+        self.dropped = collections.Counter()
+
+    def accept(self, method: str) -> bool:
+        if self.check(method):
+            return True
+        self.dropped[method] += 1
+        return False
+
+    def check(self, method: str) -> bool:
+        if self.allow_methods is not None and method not in self.allow_methods:
+            return False
+        if method in self.deny_methods:
+            return False
+        ratio = self.sample_ratios.get(method, self.sample_ratios.get(self.DEFAULT))
+        if ratio is not None and random.random() >= ratio:
+            return False
+        bucket = self.get_bucket(method)
+        if bucket is not None and not bucket.acquire():
+            return False
+        return True
+
+    def get_bucket(self, method: str) -> TokenBucket | None:
+        bucket = self.buckets.get(method)
+        if bucket is not None:
+            return bucket
+        rate = self.max_rates.get(method, self.max_rates.get(self.DEFAULT))
+        if rate is None:
+            return None
+        with self.buckets_lock:
+            return self.buckets.setdefault(method, TokenBucket(rate))
+
+    @property
+    def dropped_size(self) -> int:
+        return sum(self.dropped.values())
+
+
+def parse_method_values(items: list[str]) -> dict[str, float]:
+    """
+    Parse `method=value` items given on the command line.
+    """
+    values = {}
+    for item in items:
+        method, sep, value = item.rpartition("=")
+        if not sep or not method:
+            raise ValueError(f"expect method=value, got {item}")
+        values[method] = float(value)
+    return values
@@ -0,0 +1,140 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections.abc import Callable
+from typing import NamedTuple
+
+from thriftpy2.protocol.exc import TProtocolException
+from thriftpy2.transport import TTransportException
+
+from .message_header import I32, TMessageScanner, parse_message_header, skip_message
+from .types import ProtocolType, TransportType
+
+DEFAULT_MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+
+
+class TRawMessage(NamedTuple):
+    method: str
+    type: int
+    seqid: int
+    data: bytes  # whole message as on the wire, frame size included for framed transport
+
+
+class TMessageFramer:
+    """
+    Resumable message framer: `feed` it byte chunks of any size and get back every message completed so far.
+    A message may be split across many chunks, and one chunk may hold several pipelined messages.
+    Nothing here blocks, so it can drive both asyncio and non-blocking socket code.
+    With `accept`, messages whose method it rejects are skipped before their bytes are copied out.
+    """
+
+    def __init__(
+        self,
+        transport_type: TransportType,
+        protocol_type: ProtocolType,
+        max_message_size: int = DEFAULT_MAX_MESSAGE_SIZE,
+        accept: Callable[[str], bool] | None = None,
+    ) -> None:
+        if transport_type not in (TransportType.FRAMED, TransportType.BUFFERED):
+            raise NotImplementedError(f"Unsupported transport type {transport_type}")
+        if protocol_type not in (ProtocolType.BINARY, ProtocolType.COMPACT):
+            raise NotImplementedError(f"Unsupported protocol type {protocol_type}")
+        self.transport_type = transport_type
+        self.protocol_type = protocol_type
+        self.max_message_size = max_message_size
+        self.accept = accept
+        self.buffer = bytearray()
+        self.start = 0
+        # framed: end offset of the current frame once its size is known, buffered: unused
+        self.message_end = -1
+        # buffered: incremental scan of a partial message, which then starts at offset 0
+        self.scanner: TMessageScanner | None = None
+
+    @property
+    def pending_size(self) -> int:
+        """Bytes of an incomplete message held by the framer."""
+        return len(self.buffer) - self.start
+
+    def feed(self, chunk: bytes) -> list[TRawMessage]:
+        self.buffer += chunk
+        messages = []
+        while True:
+            if self.transport_type == TransportType.FRAMED:
+                end = self.next_frame_end()
+            else:
+                end = self.next_buffered_end()
+            if end < 0:
+                break
+            message = self.take_message(end)
+            if message is not None:
+                messages.append(message)
+        # keep only the incomplete tail around
+        self.compact()
+        return messages
+
+    def take_message(self, end: int) -> TRawMessage | None:
+        """
+        Consume the message ending at `end`, None if `accept` rejects it.
+        """
+        header_offset = 4 if self.transport_type == TransportType.FRAMED else 0
+        method, type, seqid, _ = parse_message_header(self.buffer, self.protocol_type, self.start + header_offset)
+        start = self.start
+        self.start = end
+        self.message_end = -1
+        if self.accept is not None and not self.accept(method):
+            return None
+        return TRawMessage(method, type, seqid, bytes(self.buffer[start:end]))
+
+    def compact(self):
+        if self.start > 0:
+            del self.buffer[: self.start]
+            if self.message_end >= 0:
+                self.message_end -= self.start
+            self.start = 0
+
+    def next_frame_end(self) -> int:
+        if self.message_end < 0:
+            if len(self.buffer) - self.start < 4:
+                return -1
+            (frame_size,) = I32.unpack_from(self.buffer, self.start)
+            self.check_size(frame_size)
+            self.message_end = self.start + 4 + frame_size
+        return self.message_end if self.message_end <= len(self.buffer) else -1
+
+    def next_buffered_end(self) -> int:
+        if self.start == len(self.buffer):
+            return -1
+        if self.scanner is None:
+            try:
+                return skip_message(self.buffer, self.protocol_type, self.start)
+            except TTransportException:
+                pass
+            # the partial message is scanned incrementally from now on, at an offset that no longer moves
+            self.compact()
+            self.scanner = TMessageScanner(self.protocol_type, self.start)
+        end = self.scanner.feed(self.buffer)
+        if end < 0:
+            self.check_size(len(self.buffer) - self.start)
+            return end
+        self.scanner = None
+        return end
+
+    def check_size(self, size: int):
+        if size < 0 or size > self.max_message_size:
+            raise TProtocolException(
+                TProtocolException.SIZE_LIMIT, f"message size {size} out of range (0, {self.max_message_size}]"
+            )
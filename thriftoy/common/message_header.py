@@ -0,0 +1,583 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import struct
+
+from thriftpy2.protocol.exc import TProtocolException
+from thriftpy2.transport import TTransportException
+
+from .types import ProtocolType, TransportType
+
+BINARY_VERSION_MASK = -65536  # 0xFFFF0000 as int32
+BINARY_VERSION_1 = -2147418112  # 0x80010000 as int32
+BINARY_TYPE_MASK = 0x000000FF
+
+COMPACT_PROTOCOL_ID = 0x82
+COMPACT_VERSION = 1
+COMPACT_VERSION_MASK = 0x1F
+COMPACT_TYPE_SHIFT_AMOUNT = 5
+COMPACT_TYPE_BITS = 0x07
+
+I32 = struct.Struct("!i")
+
+# thrift binary type id -> encoded size of the fixed width types
+BINARY_FIXED_SIZES = {2: 1, 3: 1, 4: 8, 6: 2, 8: 4, 10: 8}
+BINARY_STRING, BINARY_STRUCT, BINARY_MAP, BINARY_SET, BINARY_LIST = 11, 12, 13, 14, 15
+
+# thrift compact type id -> encoded size, None for varints
+COMPACT_FIXED_SIZES = {1: 1, 2: 1, 3: 1, 4: None, 5: None, 6: None, 7: 8}
+COMPACT_BINARY, COMPACT_LIST, COMPACT_SET, COMPACT_MAP, COMPACT_STRUCT = 8, 9, 10, 11, 12
+
+
+def parse_message_header(buf, protocol_type: ProtocolType, offset: int = 0) -> tuple[str, int, int, int]:
+    """
+    Parse the message header (name, type, seqid) at `offset` of `buf` without a transport,
+    return it with the offset where the message arguments start.
+    Binary accepts both strict and non-strict headers.
+    """
+    try:
+        if protocol_type == ProtocolType.BINARY:
+            return parse_binary_header(buf, offset)
+        if protocol_type == ProtocolType.COMPACT:
+            return parse_compact_header(buf, offset)
+    except (struct.error, IndexError) as e:
+        raise TProtocolException(TProtocolException.INVALID_DATA, f"truncated message header: {e}") from e
+    raise NotImplementedError(f"Unsupported protocol type {protocol_type}")
+
+
+def parse_binary_header(buf, offset: int) -> tuple[str, int, int, int]:
+    (sz,) = I32.unpack_from(buf, offset)
+    offset += 4
+    if sz < 0:
+        if sz & BINARY_VERSION_MASK != BINARY_VERSION_1:
+            raise TProtocolException(TProtocolException.BAD_VERSION, f"Bad version in message header: {sz}")
+        type = sz & BINARY_TYPE_MASK
+        (name_sz,) = I32.unpack_from(buf, offset)
+        offset += 4
+        name = read_name(buf, offset, name_sz)
+        offset += name_sz
+    else:
+        name = read_name(buf, offset, sz)
+        offset += sz
+        type = buf[offset]
+        offset += 1
+    (seqid,) = I32.unpack_from(buf, offset)
+    return name, type, seqid, offset + 4
+
+
+def parse_compact_header(buf, offset: int) -> tuple[str, int, int, int]:
+    if buf[offset] != COMPACT_PROTOCOL_ID:
+        raise TProtocolException(TProtocolException.BAD_VERSION, f"Bad protocol id in message header: {buf[offset]}")
+    ver_type = buf[offset + 1]
+    if ver_type & COMPACT_VERSION_MASK != COMPACT_VERSION:
+        raise TProtocolException(TProtocolException.BAD_VERSION, f"Bad version in message header: {ver_type}")
+    type = (ver_type >> COMPACT_TYPE_SHIFT_AMOUNT) & COMPACT_TYPE_BITS
+    seqid, offset = read_varint(buf, offset + 2)
+    name_sz, offset = read_varint(buf, offset)
+    name = read_name(buf, offset, name_sz)
+    return name, type, seqid, offset + name_sz
+
+
+def read_varint(buf, offset: int) -> tuple[int, int]:
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[offset]
+        offset += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, offset
+        shift += 7
+
+
+def write_varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def cut_seqid(data: bytes, seqid: int, transport_type: TransportType, protocol_type: ProtocolType) -> bytes | None:
+    """
+    Return `data` without its frame size and seqid, so messages differing only by seqid compare equal.
+    Return None if `paste_seqid` could not restore `data` byte for byte from it and `seqid`.
+    """
+    header_offset = 4 if transport_type == TransportType.FRAMED else 0
+    _, _, _, args_offset = parse_message_header(data, protocol_type, header_offset)
+    if protocol_type == ProtocolType.BINARY:
+        start, end = args_offset - 4, args_offset
+    elif seqid >= 0:
+        start, end = header_offset + 2, read_varint(data, header_offset + 2)[1]
+    else:
+        return None
+    cut = bytes(data[header_offset:start]) + bytes(data[end:])
+    try:
+        restored = paste_seqid(cut, seqid, transport_type, protocol_type)
+    except struct.error:
+        return None
+    return cut if restored == data else None
+
+
+def paste_seqid(cut: bytes, seqid: int, transport_type: TransportType, protocol_type: ProtocolType) -> bytes:
+    """
+    Inverse of `cut_seqid`.
+    """
+    if protocol_type == ProtocolType.BINARY:
+        (sz,) = I32.unpack_from(cut, 0)
+        start = 8 + I32.unpack_from(cut, 4)[0] if sz < 0 else 4 + sz + 1
+        encoded = I32.pack(seqid)
+    elif protocol_type == ProtocolType.COMPACT:
+        start = 2
+        encoded = write_varint(seqid)
+    else:
+        raise NotImplementedError(f"Unsupported protocol type {protocol_type}")
+    body = cut[:start] + encoded + cut[start:]
+    if transport_type == TransportType.FRAMED:
+        return I32.pack(len(body)) + body
+    return body
+
+
+def read_name(buf, offset: int, size: int) -> str:
+    if size < 0 or offset + size > len(buf):
+        raise TProtocolException(TProtocolException.INVALID_DATA, f"bad method name size: {size}")
+    return str(buf[offset : offset + size], "utf-8")
+
+
+def skip_message(buf, protocol_type: ProtocolType, offset: int = 0) -> int:
+    """
+    Find the end of the message starting at `offset` of `buf` without building any value.
+    Raise TTransportException(END_OF_FILE) if `buf` ends before the message does.
+    """
+    try:
+        if protocol_type == ProtocolType.BINARY:
+            end = skip_binary_struct(buf, skip_binary_header(buf, offset))
+        elif protocol_type == ProtocolType.COMPACT:
+            end = skip_compact_struct(buf, skip_compact_header(buf, offset))
+        else:
+            raise NotImplementedError(f"Unsupported protocol type {protocol_type}")
+    except (struct.error, IndexError) as e:
+        raise TTransportException(TTransportException.END_OF_FILE, "partial message") from e
+    if end > len(buf):
+        raise TTransportException(TTransportException.END_OF_FILE, "partial message")
+    return end
+
+
+def skip_binary_header(buf, offset: int) -> int:
+    (sz,) = I32.unpack_from(buf, offset)
+    if sz < 0:
+        if sz & BINARY_VERSION_MASK != BINARY_VERSION_1:
+            raise TProtocolException(TProtocolException.BAD_VERSION, f"Bad version in message header: {sz}")
+        (name_sz,) = I32.unpack_from(buf, offset + 4)
+        return offset + 12 + check_size(name_sz)
+    return offset + 9 + sz
+
+
+def skip_binary_struct(buf, offset: int) -> int:
+    while True:
+        ttype = buf[offset]
+        if ttype == 0:
+            return offset + 1
+        offset = skip_binary_value(buf, offset + 3, ttype)
+
+
+def skip_binary_value(buf, offset: int, ttype: int) -> int:
+    size = BINARY_FIXED_SIZES.get(ttype)
+    if size is not None:
+        return offset + size
+    if ttype == BINARY_STRING:
+        (size,) = I32.unpack_from(buf, offset)
+        return offset + 4 + check_size(size)
+    if ttype == BINARY_STRUCT:
+        return skip_binary_struct(buf, offset)
+    if ttype == BINARY_MAP:
+        ktype, vtype = buf[offset], buf[offset + 1]
+        (size,) = I32.unpack_from(buf, offset + 2)
+        offset += 6
+        ksize, vsize = BINARY_FIXED_SIZES.get(ktype), BINARY_FIXED_SIZES.get(vtype)
+        if ksize is not None and vsize is not None:
+            return offset + check_size(size) * (ksize + vsize)
+        for _ in range(check_size(size)):
+            offset = skip_binary_value(buf, offset, ktype)
+            offset = skip_binary_value(buf, offset, vtype)
+        return offset
+    if ttype == BINARY_SET or ttype == BINARY_LIST:
+        etype = buf[offset]
+        (size,) = I32.unpack_from(buf, offset + 1)
+        offset += 5
+        esize = BINARY_FIXED_SIZES.get(etype)
+        if esize is not None:
+            return offset + check_size(size) * esize
+        for _ in range(check_size(size)):
+            offset = skip_binary_value(buf, offset, etype)
+        return offset
+    raise TProtocolException(TProtocolException.INVALID_DATA, f"Unknown binary type: {ttype}")
+
+
+def skip_compact_header(buf, offset: int) -> int:
+    if buf[offset] != COMPACT_PROTOCOL_ID:
+        raise TProtocolException(TProtocolException.BAD_VERSION, f"Bad protocol id in message header: {buf[offset]}")
+    offset = skip_varint(buf, offset + 2)
+    name_sz, offset = read_varint(buf, offset)
+    return offset + name_sz
+
+
+def skip_compact_struct(buf, offset: int) -> int:
+    while True:
+        header = buf[offset]
+        if header == 0:
+            return offset + 1
+        offset += 1
+        if header & 0xF0 == 0:
+            offset = skip_varint(buf, offset)
+        ttype = header & 0x0F
+        # booleans are stored in the field header
+        if ttype != 1 and ttype != 2:
+            offset = skip_compact_value(buf, offset, ttype)
+
+
+def skip_compact_value(buf, offset: int, ttype: int) -> int:
+    if ttype in COMPACT_FIXED_SIZES:
+        size = COMPACT_FIXED_SIZES[ttype]
+        return skip_varint(buf, offset) if size is None else offset + size
+    if ttype == COMPACT_BINARY:
+        size, offset = read_varint(buf, offset)
+        return offset + size
+    if ttype == COMPACT_STRUCT:
+        return skip_compact_struct(buf, offset)
+    if ttype == COMPACT_LIST or ttype == COMPACT_SET:
+        header = buf[offset]
+        offset += 1
+        size, etype = header >> 4, header & 0x0F
+        if size == 15:
+            size, offset = read_varint(buf, offset)
+        esize = COMPACT_FIXED_SIZES.get(etype)
+        if esize is not None:
+            return offset + size * esize
+        for _ in range(size):
+            offset = skip_compact_value(buf, offset, etype)
+        return offset
+    if ttype == COMPACT_MAP:
+        size, offset = read_varint(buf, offset)
+        if size == 0:
+            return offset
+        ktype, vtype = buf[offset] >> 4, buf[offset] & 0x0F
+        offset += 1
+        ksize, vsize = COMPACT_FIXED_SIZES.get(ktype), COMPACT_FIXED_SIZES.get(vtype)
+        if ksize is not None and vsize is not None:
+            return offset + size * (ksize + vsize)
+        for _ in range(size):
+            offset = skip_compact_value(buf, offset, ktype)
+            offset = skip_compact_value(buf, offset, vtype)
+        return offset
+    raise TProtocolException(TProtocolException.INVALID_DATA, f"Unknown compact type: {ttype}")
+
+
+def skip_varint(buf, offset: int) -> int:
+    while buf[offset] & 0x80:
+        offset += 1
+    return offset + 1
+
+
+def check_size(size: int) -> int:
+    if size < 0:
+        raise TProtocolException(TProtocolException.NEGATIVE_SIZE, f"Negative size: {size}")
+    return size
+
+
+class TMessageScanner:
+    """
+    Resumable `skip_message` for a message arriving in pieces: `feed` the buffer holding it each time it grew,
+    and get the message end offset once it is complete, -1 before.
+    Scanning picks up where the previous `feed` stopped, so offsets in the buffer must not move in between.
+    """
+
+    def __init__(self, protocol_type: ProtocolType, offset: int = 0) -> None:
+        if protocol_type == ProtocolType.BINARY:
+            self.steps = self.scan_binary_message(offset)
+        elif protocol_type == ProtocolType.COMPACT:
+            self.steps = self.scan_compact_message(offset)
+        else:
+            raise NotImplementedError(f"Unsupported protocol type {protocol_type}")
+        self.buf = b""
+        self.needed = 0
+
+    def feed(self, buf) -> int:
+        if len(buf) < self.needed:
+            return -1
+        self.buf = buf
+        try:
+            self.needed = next(self.steps)
+        except StopIteration as e:
+            self.buf = b""
+            return e.value
+        return -1
+
+    def need(self, end: int):
+        while len(self.buf) < end:
+            yield end
+
+    def scan_binary_message(self, offset: int):
+        yield from self.need(offset + 4)
+        (sz,) = I32.unpack_from(self.buf, offset)
+        if sz < 0:
+            if sz & BINARY_VERSION_MASK != BINARY_VERSION_1:
+                raise TProtocolException(TProtocolException.BAD_VERSION, f"Bad version in message header: {sz}")
+            yield from self.need(offset + 8)
+            (name_sz,) = I32.unpack_from(self.buf, offset + 4)
+            offset += 12 + check_size(name_sz)
+        else:
+            offset += 9 + sz
+        end = yield from self.scan_binary_struct(offset)
+        yield from self.need(end)
+        return end
+
+    def scan_binary_struct(self, offset: int):
+        while True:
+            yield from self.need(offset + 1)
+            ttype = self.buf[offset]
+            if ttype == 0:
+                return offset + 1
+            offset = yield from self.scan_binary_value(offset + 3, ttype)
+
+    def scan_binary_value(self, offset: int, ttype: int):
+        size = BINARY_FIXED_SIZES.get(ttype)
+        if size is not None:
+            return offset + size
+        if ttype == BINARY_STRING:
+            yield from self.need(offset + 4)
+            (size,) = I32.unpack_from(self.buf, offset)
+            return offset + 4 + check_size(size)
+        if ttype == BINARY_STRUCT:
+            return (yield from self.scan_binary_struct(offset))
+        if ttype == BINARY_MAP:
+            yield from self.need(offset + 6)
+            ktype, vtype = self.buf[offset], self.buf[offset + 1]
+            (size,) = I32.unpack_from(self.buf, offset + 2)
+            offset += 6
+            ksize, vsize = BINARY_FIXED_SIZES.get(ktype), BINARY_FIXED_SIZES.get(vtype)
+            if ksize is not None and vsize is not None:
+                return offset + check_size(size) * (ksize + vsize)
+            for _ in range(check_size(size)):
+                offset = yield from self.scan_binary_value(offset, ktype)
+                offset = yield from self.scan_binary_value(offset, vtype)
+            return offset
+        if ttype == BINARY_SET or ttype == BINARY_LIST:
+            yield from self.need(offset + 5)
+            etype = self.buf[offset]
+            (size,) = I32.unpack_from(self.buf, offset + 1)
+            offset += 5
+            esize = BINARY_FIXED_SIZES.get(etype)
+            if esize is not None:
+                return offset + check_size(size) * esize
+            for _ in range(check_size(size)):
+                offset = yield from self.scan_binary_value(offset, etype)
+            return offset
+        raise TProtocolException(TProtocolException.INVALID_DATA, f"Unknown binary type: {ttype}")
+
+    def scan_compact_message(self, offset: int):
+        yield from self.need(offset + 2)
+        if self.buf[offset] != COMPACT_PROTOCOL_ID:
+            raise TProtocolException(
+                TProtocolException.BAD_VERSION, f"Bad protocol id in message header: {self.buf[offset]}"
+            )
+        offset = yield from self.scan_varint(offset + 2)
+        name_sz, offset = yield from self.read_varint(offset)
+        end = yield from self.scan_compact_struct(offset + name_sz)
+        yield from self.need(end)
+        return end
+
+    def scan_compact_struct(self, offset: int):
+        while True:
+            yield from self.need(offset + 1)
+            header = self.buf[offset]
+            if header == 0:
+                return offset + 1
+            offset += 1
+            if header & 0xF0 == 0:
+                offset = yield from self.scan_varint(offset)
+            ttype = header & 0x0F
+            # booleans are stored in the field header
+            if ttype != 1 and ttype != 2:
+                offset = yield from self.scan_compact_value(offset, ttype)
+
+    def scan_compact_value(self, offset: int, ttype: int):
+        if ttype in COMPACT_FIXED_SIZES:
+            size = COMPACT_FIXED_SIZES[ttype]
+            return (yield from self.scan_varint(offset)) if size is None else offset + size
+        if ttype == COMPACT_BINARY:
+            size, offset = yield from self.read_varint(offset)
+            return offset + size
+        if ttype == COMPACT_STRUCT:
+            return (yield from self.scan_compact_struct(offset))
+        if ttype == COMPACT_LIST or ttype == COMPACT_SET:
+            yield from self.need(offset + 1)
+            header = self.buf[offset]
+            offset += 1
+            size, etype = header >> 4, header & 0x0F
+            if size == 15:
+                size, offset = yield from self.read_varint(offset)
+            esize = COMPACT_FIXED_SIZES.get(etype)
+            if esize is not None:
+                return offset + size * esize
+            for _ in range(size):
+                offset = yield from self.scan_compact_value(offset, etype)
+            return offset
+        if ttype == COMPACT_MAP:
+            size, offset = yield from self.read_varint(offset)
+            if size == 0:
+                return offset
+            yield from self.need(offset + 1)
+            ktype, vtype = self.buf[offset] >> 4, self.buf[offset] & 0x0F
+            offset += 1
+            ksize, vsize = COMPACT_FIXED_SIZES.get(ktype), COMPACT_FIXED_SIZES.get(vtype)
+            if ksize is not None and vsize is not None:
+                return offset + size * (ksize + vsize)
+            for _ in range(size):
+                offset = yield from self.scan_compact_value(offset, ktype)
+                offset = yield from self.scan_compact_value(offset, vtype)
+            return offset
+        raise TProtocolException(TProtocolException.INVALID_DATA, f"Unknown compact type: {ttype}")
+
+    def scan_varint(self, offset: int):
+        while True:
+            yield from self.need(offset + 1)
+            if not self.buf[offset] & 0x80:
+                return offset + 1
+            offset += 1
+
+    def read_varint(self, offset: int):
+        result = 0
+        shift = 0
+        while True:
+            yield from self.need(offset + 1)
+            byte = self.buf[offset]
+            offset += 1
+            result |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return result, offset
+            shift += 7
+
+
+class TFramedSocketReader:
+    """
+    Read whole frames (4-byte size included) straight from a socket into one reusable buffer.
+    The returned view is only valid until the next `read_frame`.
+    """
+
+    def __init__(self, sock: socket.socket, buf_size: int = 65536) -> None:
+        self.sock = sock
+        self.buf = bytearray(buf_size)
+        self.view = memoryview(self.buf)
+
+    def read_frame(self) -> memoryview:
+        self.recv_into(0, 4)
+        (frame_size,) = I32.unpack_from(self.buf, 0)
+        if frame_size < 0:
+            raise TProtocolException(TProtocolException.INVALID_DATA, f"bad frame size: {frame_size}")
+        if frame_size + 4 > len(self.buf):
+            self.view.release()
+            self.buf = self.buf[:4] + bytearray(max(frame_size, 2 * len(self.buf)))
+            self.view = memoryview(self.buf)
+        self.recv_into(4, frame_size)
+        return self.view[: frame_size + 4]
+
+    def recv_into(self, offset: int, size: int):
+        end = offset + size
+        while offset < end:
+            try:
+                received = self.sock.recv_into(self.view[offset:end], end - offset, socket.MSG_WAITALL)
+            except TimeoutError as e:
+                raise TTransportException(TTransportException.TIMED_OUT, "socket read timed out") from e
+            except InterruptedError:
+                continue
+            if received == 0:
+                raise TTransportException(TTransportException.END_OF_FILE, "socket read 0 bytes")
+            offset += received
+
+
+class TBufferedSocketReader:
+    """
+    Read whole unframed messages straight from a socket, using `skip_message` to find where each one ends.
+    Bytes past the message end are kept for the next call; the returned view is only valid until then.
+    """
+
+    def __init__(self, sock: socket.socket, protocol_type: ProtocolType, buf_size: int = 65536) -> None:
+        self.sock = sock
+        self.protocol_type = protocol_type
+        self.buf = bytearray(buf_size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        # incremental scan of the partial message at the front
+        self.scanner: TMessageScanner | None = None
+
+    def read_message(self) -> memoryview:
+        while True:
+            if self.start < self.end:
+                message_end = self.scan()
+                if message_end >= 0:
+                    message = self.view[self.start : message_end]
+                    self.start = message_end
+                    return message
+            self.fill()
+
+    def scan(self) -> int:
+        """
+        Return the end of the message at `start`, -1 if incomplete.
+        An incomplete message is moved to the front and scanned incrementally from then on, so a message
+        split across many reads is scanned once.
+        """
+        if self.scanner is None:
+            try:
+                return skip_message(self.view[: self.end], self.protocol_type, self.start)
+            except TTransportException:
+                pass
+            if self.start > 0:
+                self.move_to_front()
+            self.scanner = TMessageScanner(self.protocol_type, self.start)
+        message_end = self.scanner.feed(self.view[: self.end])
+        if message_end >= 0:
+            self.scanner = None
+        return message_end
+
+    def fill(self):
+        # move the partial message to the front, into a new buffer if it is already full
+        if self.start == 0 and self.end == len(self.buf):
+            self.view.release()
+            self.buf = self.buf + bytearray(len(self.buf))
+            self.view = memoryview(self.buf)
+        elif self.start > 0:
+            self.move_to_front()
+        while True:
+            try:
+                received = self.sock.recv_into(self.view[self.end :])
+            except TimeoutError as e:
+                raise TTransportException(TTransportException.TIMED_OUT, "socket read timed out") from e
+            except InterruptedError:
+                continue
+            break
+        if received == 0:
+            raise TTransportException(TTransportException.END_OF_FILE, "socket read 0 bytes")
+        self.end += received
+
+    def move_to_front(self):
+        size = self.end - self.start
+        self.buf[:size] = bytes(self.view[self.start : self.end])
+        self.start, self.end = 0, size
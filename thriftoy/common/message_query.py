@@ -0,0 +1,110 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+from collections.abc import Sequence
+
+import sqlalchemy
+import sqlmodel
+
+from .message import TMessage, check_message_schema, message_conditions, message_entities, select_message_page
+
+# max ids bound into one IN (...) clause
+ID_BATCH_SIZE = 500
+# below this share of matching ids in [min(id), max(id)], sampling collects the matching ids instead of probing
+MIN_SAMPLE_DENSITY = 0.05
+
+
+def count_messages(engine: sqlalchemy.Engine, schema=TMessage, **filters) -> int:
+    """
+    Count messages matching `filters` (see `message_conditions`).
+    """
+    statement = sqlmodel.select(sqlalchemy.func.count()).select_from(schema)
+    statement = statement.where(*message_conditions(schema, **filters))
+    check_message_schema(engine)
+    with sqlmodel.Session(engine) as session:
+        return session.exec(statement).one()
+
+
+def fetch_messages(
+    engine: sqlalchemy.Engine,
+    after_id: int | None = None,
+    page_size: int = 1000,
+    columns: Sequence[str] | None = None,
+    schema=TMessage,
+    **filters,
+) -> tuple[list, int | None]:
+    """
+    Fetch one keyset page of messages matching `filters`, in id order.
+    Return the page with the `after_id` of the next one, None once there is no next page.
+    """
+    conditions = message_conditions(schema, **filters)
+    check_message_schema(engine)
+    with sqlmodel.Session(engine) as session:
+        return select_message_page(session, columns, conditions, page_size, after_id, schema)
+
+
+def sample_messages(
+    engine: sqlalchemy.Engine,
+    size: int,
+    columns: Sequence[str] | None = None,
+    seed: int | None = None,
+    schema=TMessage,
+    **filters,
+) -> list:
+    """
+    Uniformly sample up to `size` messages matching `filters`, returned in id order.
+    Random ids are probed through the primary key, so the table is never scanned;
+    sparse filters fall back to picking from the matching ids read off their index.
+    """
+    rng = random.Random(seed)
+    conditions = message_conditions(schema, **filters)
+    check_message_schema(engine)
+    with sqlmodel.Session(engine) as session:
+        entities, convert = message_entities(session, columns, schema)
+        low, high = session.exec(sqlmodel.select(sqlalchemy.func.min(schema.id), sqlalchemy.func.max(schema.id))).one()
+        if low is None or size <= 0:
+            return []
+        span = high - low + 1
+        count = session.exec(sqlmodel.select(sqlalchemy.func.count()).select_from(schema).where(*conditions)).one()
+        if 4 * size > count or count < span * MIN_SAMPLE_DENSITY:
+            ids = session.exec(sqlmodel.select(schema.id).where(*conditions)).all()
+            chosen = rng.sample(ids, min(size, len(ids)))
+        else:
+            chosen = probe_ids(session, schema, conditions, low, high, size, rng)
+        chosen.sort()
+        rows = []
+        for i in range(0, len(chosen), ID_BATCH_SIZE):
+            statement = sqlmodel.select(*entities).where(schema.id.in_(chosen[i : i + ID_BATCH_SIZE]))
+            rows.extend(convert(session.exec(statement.order_by(schema.id)).all()))
+    return rows
+
+
+def probe_ids(session: sqlmodel.Session, schema, conditions: list, low: int, high: int, size: int, rng) -> list[int]:
+    found: set[int] = set()
+    tried: set[int] = set()
+    span = high - low + 1
+    while len(found) < size and len(tried) < span:
+        batch = set()
+        while len(batch) < min(ID_BATCH_SIZE, span - len(tried)):
+            candidate = rng.randint(low, high)
+            if candidate not in tried:
+                batch.add(candidate)
+        tried |= batch
+        statement = sqlmodel.select(schema.id).where(schema.id.in_(batch), *conditions)
+        found.update(session.exec(statement).all())
+    return rng.sample(sorted(found), min(size, len(found)))
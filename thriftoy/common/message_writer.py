@@ -0,0 +1,485 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import logging
+import re
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import sqlalchemy
+import sqlmodel
+
+from .capture_log import RECORD_PREFIX, CaptureLogWriter, pack_record, unpack_record
+from .message import (
+    TConnection,
+    TMessage,
+    TMessageBlob,
+    TPayloadDictionary,
+    create_message_indexes,
+    message_blob_hash,
+    save_payload_dictionary,
+    upgrade_message_schema,
+)
+from .message_header import cut_seqid
+from .metrics import Histogram
+from .payload_codec import PayloadCompressor
+from .types import PayloadCodec, ProtocolType, TransportType
+
+
+def enable_sqlite_wal(engine: sqlalchemy.Engine):
+    """
+    Switch every sqlite connection of `engine` to WAL journal with synchronous=NORMAL,
+    so a commit no longer costs a fsync of the main database file.
+    """
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    return engine
+
+
+class TMessageSpillFile:
+    """
+    FIFO of `TMessage` in a temporary file, records use the capture log format.
+    Once `max_size` bytes are pending, `push` refuses new messages.
+    """
+
+    def __init__(self, directory: Path | None = None, max_size: int = 4 * 1024 * 1024 * 1024) -> None:
+        self.file = tempfile.TemporaryFile(prefix="thriftoy-spill-", dir=directory)
+        self.max_size = max_size
+        self.read_offset = 0
+        self.write_offset = 0
+        self.pending_size = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.pending_size
+
+    def push(self, message: TMessage) -> bool:
+        record = pack_record(message, message.timestamp or time.time_ns())
+        with self.lock:
+            if self.write_offset - self.read_offset + len(record) > self.max_size:
+                return False
+            self.file.seek(self.write_offset)
+            self.file.write(record)
+            self.write_offset += len(record)
+            self.pending_size += 1
+        return True
+
+    def pop_batch(self, batch_size: int) -> list[TMessage]:
+        batch = []
+        with self.lock:
+            self.file.seek(self.read_offset)
+            while len(batch) < batch_size and self.read_offset < self.write_offset:
+                prefix = self.file.read(RECORD_PREFIX.size)
+                header_size, data_size = RECORD_PREFIX.unpack(prefix)
+                buf = memoryview(prefix + self.file.read(header_size + data_size))
+                record, size = unpack_record(buf, 0)
+                batch.append(record.to_message())
+                self.read_offset += size
+            self.pending_size -= len(batch)
+            if self.read_offset == self.write_offset:
+                self.file.truncate(0)
+                self.read_offset = self.write_offset = 0
+        return batch
+
+    def close(self):
+        self.file.close()
+
+
+class TMessageBatchWriter:
+    """
+    Persist `TMessage` from a dedicated writer thread.
+    Messages are committed in one transaction per `batch_size` messages or `linger_ms`
+    milliseconds, whichever comes first.
+
+    At most `max_pending_size` messages / `max_pending_bytes` payload bytes are held in memory.
+    Beyond that, messages overflow into `spill_file` and are persisted once memory is drained,
+    `put` blocks if there is no spill file, and messages are dropped if the spill file is full.
+
+    With `dedup`, payloads are stored once per content in `TMessageBlob` (seqid masked out).
+    With `compressor`, other payloads are stored compressed when that makes them smaller.
+    """
+
+    # seconds without messages after which `on_idle` is called, None to never wake up
+    idle_interval: float | None = None
+    # blob ids remembered by hash, beyond that they are looked up again
+    max_cached_blobs = 1 << 20
+    # connection rows remembered by peer, least recently used first, beyond that a returning peer gets a new row
+    max_cached_connections = 1 << 16
+
+    def __init__(
+        self,
+        engine,
+        batch_size: int = 256,
+        linger_ms: int = 50,
+        max_pending_size: int = 65536,
+        max_pending_bytes: int = 256 * 1024 * 1024,
+        spill_file: TMessageSpillFile | None = None,
+        dedup: bool = False,
+        compressor: PayloadCompressor | None = None,
+    ):
+        self.engine = engine
+        self.dedup = dedup
+        self.compressor = compressor
+        # whether the preset dictionary of `compressor` is stored in the current database
+        self.dictionary_saved = False
+        self.batch_size = max(batch_size, 1)
+        self.linger = linger_ms / 1000
+        self.max_pending_size = max_pending_size
+        self.max_pending_bytes = max_pending_bytes
+        self.spill_file = spill_file
+        self.pending = collections.deque()
+        self.pending_bytes = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        self.written_size = 0
+        self.spilled_size = 0
+        self.dropped_size = 0
+        self.connections: collections.OrderedDict[tuple, TConnection] = collections.OrderedDict()
+        self.blob_ids: dict[bytes, int] = {}
+        self.commit_seconds = Histogram("thriftoy_writer_commit_seconds", "Latency of committing one batch")
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def pending_size(self) -> int:
+        return len(self.pending) + (len(self.spill_file) if self.spill_file else 0)
+
+    def is_full(self, size: int) -> bool:
+        if not self.pending:
+            return False
+        return len(self.pending) >= self.max_pending_size or self.pending_bytes + size > self.max_pending_bytes
+
+    def put(self, message: TMessage):
+        size = len(message.data)
+        with self.cond:
+            if self.spill_file is not None:
+                # keep spilling until the spill file is drained, so messages are persisted in order
+                if len(self.spill_file) or self.is_full(size):
+                    if self.spill_file.push(message):
+                        self.spilled_size += 1
+                    else:
+                        self.dropped_size += 1
+                    self.cond.notify()
+                    return
+            while self.is_full(size) and not self.closed:
+                self.cond.wait()
+            self.pending.append(message)
+            self.pending_bytes += size
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.spill_file is not None:
+            self.spill_file.close()
+
+    def take_batch(self) -> list[TMessage] | None:
+        with self.cond:
+            while not self.pending and not (self.spill_file and len(self.spill_file)) and not self.closed:
+                if not self.cond.wait(self.idle_interval):
+                    return []
+            if self.pending:
+                deadline = time.monotonic() + self.linger
+                while len(self.pending) < self.batch_size and not self.closed:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.cond.wait(timeout)
+                batch = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+                self.pending_bytes -= sum(len(message.data) for message in batch)
+                self.cond.notify_all()
+                return batch
+        if self.spill_file is not None and len(self.spill_file):
+            return self.spill_file.pop_batch(self.batch_size)
+        return None
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            if batch is None:
+                break
+            if not batch:
+                self.on_idle()
+                continue
+            start = time.perf_counter()
+            try:
+                self.write_batch(batch)
+            except Exception as e:
+                logging.exception("TMessageBatchWriter: write %d messages failed: %s", len(batch), e)
+                self.dropped_size += len(batch)
+                continue
+            self.commit_seconds.observe(time.perf_counter() - start)
+            self.written_size += len(batch)
+
+    def on_idle(self):
+        pass
+
+    def write_batch(self, batch: list[TMessage]):
+        # rows added by this batch are only cached once committed, a failed batch leaves no dangling id behind
+        connections: dict[tuple, TConnection] = {}
+        blob_ids: dict[bytes, int] = {}
+        with sqlmodel.Session(self.engine, expire_on_commit=False) as session:
+            for message in batch:
+                # messages of one connection share a single TConnection row owned by the writer
+                if message.connection is not None:
+                    key = message.connection.key()
+                    connection = self.connections.get(key) or connections.get(key)
+                    if key in self.connections:
+                        self.connections.move_to_end(key)
+                    elif connection is None:
+                        connection = TConnection(**message.connection.model_dump(exclude={"id"}))
+                        connections[key] = connection
+                    message.connection = connection
+            if self.dedup:
+                blob_ids = self.dedup_batch(session, batch)
+            if self.compressor is not None:
+                self.compress_batch(session, batch)
+            session.add_all(batch)
+            session.commit()
+        self.connections.update(connections)
+        while len(self.connections) > self.max_cached_connections:
+            self.connections.popitem(last=False)
+        self.blob_ids.update(blob_ids)
+        if self.compressor is not None:
+            self.dictionary_saved = True
+
+    def compress_batch(self, session: sqlmodel.Session, batch: list[TMessage]):
+        if self.compressor.dictionary and not self.dictionary_saved:
+            save_payload_dictionary(session, self.compressor.dictionary)
+        for message in batch:
+            if message.data and message.codec == PayloadCodec.RAW:
+                compressed = self.compressor.compress(message.data)
+                if compressed is not None:
+                    message.data = compressed
+                    message.codec = self.compressor.codec
+
+    def dedup_batch(self, session: sqlmodel.Session, batch: list[TMessage]) -> dict[bytes, int]:
+        """
+        Point messages at the blob of their payload and empty their `data`, adding missing blobs
+        and bumping the repeat count of known ones.
+        Return the blob ids not cached yet, to be cached once the batch is committed.
+        """
+        keys = []
+        cuts: dict[bytes, bytes] = {}
+        repeats: collections.Counter[bytes] = collections.Counter()
+        for message in batch:
+            cut = cut_seqid(
+                message.data,
+                message.seqid,
+                TransportType(message.transport_type),
+                ProtocolType(message.protocol_type),
+            )
+            key = None if cut is None else message_blob_hash(cut)
+            if key is not None:
+                cuts.setdefault(key, cut)
+                repeats[key] += 1
+            keys.append(key)
+        if len(self.blob_ids) + len(cuts) > self.max_cached_blobs:
+            self.blob_ids = {}
+        missing = [key for key in cuts if key not in self.blob_ids]
+        blob_ids: dict[bytes, int] = {}
+        for i in range(0, len(missing), 500):
+            statement = sqlmodel.select(TMessageBlob.hash, TMessageBlob.id).where(
+                TMessageBlob.hash.in_(missing[i : i + 500])
+            )
+            blob_ids.update(session.exec(statement).all())
+        known = [
+            {"blob_id": self.blob_ids.get(key) or blob_ids[key], "repeats": repeats[key]}
+            for key in cuts
+            if key in self.blob_ids or key in blob_ids
+        ]
+        blobs = [
+            TMessageBlob(hash=key, data=cuts[key], repeat_count=repeats[key]) for key in missing if key not in blob_ids
+        ]
+        session.add_all(blobs)
+        session.flush()
+        blob_ids.update((blob.hash, blob.id) for blob in blobs)
+        if known:
+            table = TMessageBlob.__table__
+            statement = (
+                table.update()
+                .where(table.c.id == sqlalchemy.bindparam("blob_id"))
+                .values(repeat_count=table.c.repeat_count + sqlalchemy.bindparam("repeats"))
+            )
+            session.connection().execute(statement, known)
+        for message, key in zip(batch, keys, strict=True):
+            if key is not None:
+                message.blob_id = self.blob_ids.get(key) or blob_ids[key]
+                message.data = b""
+        return blob_ids
+
+
+class TMessageRotatingBatchWriter(TMessageBatchWriter):
+    """
+    `TMessageBatchWriter` into sqlite files which rotate once one reaches `rotate_size` bytes,
+    `rotate_messages` messages or `rotate_seconds` seconds (0 disables a limit).
+
+    Rotated files are written as `<stem>.<N><suffix>.part` and renamed to `<stem>.<N><suffix>`
+    once finalized, so a file without `.part` is complete and safe to read.
+    Without any limit, messages go to `path` itself.
+    """
+
+    idle_interval = 1.0
+
+    def __init__(
+        self,
+        path: Path,
+        rotate_size: int = 0,
+        rotate_messages: int = 0,
+        rotate_seconds: int = 0,
+        clean: bool = False,
+        echo: bool = False,
+        **kwargs,
+    ):
+        self.path = Path(path)
+        self.rotate_size = rotate_size
+        self.rotate_messages = rotate_messages
+        self.rotate_seconds = rotate_seconds
+        self.clean = clean
+        self.echo = echo
+        self.rotating = rotate_size > 0 or rotate_messages > 0 or rotate_seconds > 0
+        if clean:
+            remove_rotated_files(self.path)
+        self.file_id = max(rotated_file_ids(self.path), default=-1) + 1
+        self.closed_files: list[Path] = []
+        self.open_file()
+        super().__init__(self.engine, **kwargs)
+
+    def open_file(self):
+        if self.rotating:
+            path = rotated_path(self.path, self.file_id)
+            self.file_path = path.with_name(path.name + ".part")
+            self.file_id += 1
+        else:
+            self.file_path = self.path
+        self.engine = enable_sqlite_wal(sqlmodel.create_engine(f"sqlite:///{self.file_path}", echo=self.echo))
+        if self.clean:
+            sqlmodel.SQLModel.metadata.drop_all(self.engine)
+        sqlmodel.SQLModel.metadata.create_all(self.engine, tables=CAPTURE_TABLES)
+        upgrade_message_schema(self.engine)
+        # connection and blob ids, and the preset dictionary are per file
+        self.connections = collections.OrderedDict()
+        self.blob_ids = {}
+        self.dictionary_saved = False
+        self.file_messages = 0
+        self.file_start = time.monotonic()
+
+    def close_file(self):
+        finalize_sqlite_capture(self.engine)
+        if self.rotating:
+            path = self.file_path.with_suffix("")
+            self.file_path.rename(path)
+            self.closed_files.append(path)
+            logging.info("TMessageRotatingBatchWriter: closed %s with %d messages", path, self.file_messages)
+
+    def should_rotate(self) -> bool:
+        if not self.rotating or self.file_messages == 0:
+            return False
+        if self.rotate_messages > 0 and self.file_messages >= self.rotate_messages:
+            return True
+        if self.rotate_seconds > 0 and time.monotonic() - self.file_start >= self.rotate_seconds:
+            return True
+        if self.rotate_size > 0:
+            size = sum(p.stat().st_size for p in (self.file_path, wal_path(self.file_path)) if p.exists())
+            if size >= self.rotate_size:
+                return True
+        return False
+
+    def rotate(self):
+        self.close_file()
+        self.open_file()
+
+    def write_batch(self, batch: list[TMessage]):
+        super().write_batch(batch)
+        self.file_messages += len(batch)
+        if self.should_rotate():
+            self.rotate()
+
+    def on_idle(self):
+        if self.should_rotate():
+            self.rotate()
+
+    def close(self):
+        super().close()
+        self.close_file()
+
+
+CAPTURE_TABLES = [TConnection.__table__, TMessageBlob.__table__, TPayloadDictionary.__table__, TMessage.__table__]
+
+
+def finalize_sqlite_capture(engine: sqlalchemy.Engine):
+    """
+    Build the message indexes, fold the WAL back into the database file and release it.
+    """
+    create_message_indexes(engine)
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.exec_driver_sql("PRAGMA journal_mode=DELETE")
+    engine.dispose()
+
+
+def rotated_path(path: Path, file_id: int) -> Path:
+    return path.with_name(f"{path.stem}.{file_id:06d}{path.suffix}")
+
+
+def rotated_file_ids(path: Path) -> list[int]:
+    pattern = re.compile(rf"{re.escape(path.stem)}\.(\d+){re.escape(path.suffix)}(\.part)?")
+    matches = (pattern.fullmatch(p.name) for p in path.parent.glob(f"{path.stem}.*"))
+    return [int(m.group(1)) for m in matches if m]
+
+
+def remove_rotated_files(path: Path):
+    """
+    Remove the rotated files of `path` left by earlier runs, finalized or `.part`, with their sqlite journals.
+    """
+    for file_id in rotated_file_ids(path):
+        rotated = rotated_path(path, file_id)
+        for file in (rotated, rotated.with_name(rotated.name + ".part")):
+            for name in (file.name, file.name + "-wal", file.name + "-shm"):
+                file.with_name(name).unlink(missing_ok=True)
+
+
+def wal_path(path: Path) -> Path:
+    return path.with_name(path.name + "-wal")
+
+
+class TMessageLogBatchWriter(TMessageBatchWriter):
+    """
+    `TMessageBatchWriter` appending every batch to a segmented `CaptureLogWriter` instead of sqlite.
+    """
+
+    def __init__(self, log: CaptureLogWriter, **kwargs):
+        self.log = log
+        super().__init__(None, **kwargs)
+
+    def close(self):
+        super().close()
+        self.log.close()
+
+    def write_batch(self, batch: list[TMessage]):
+        self.log.append(batch)
@@ -0,0 +1,129 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import functools
+import heapq
+import zlib
+from collections.abc import Callable, Iterable
+
+from .types import PayloadCodec
+
+# zlib only looks this far back, a larger dictionary is never matched
+MAX_DICTIONARY_SIZE = 32 * 1024
+
+
+class PayloadCompressor:
+    """
+    Compress payloads with `codec`, priming zlib with `dictionary` once and copying the primed
+    stream for every payload.
+    """
+
+    def __init__(self, codec: PayloadCodec, dictionary: bytes | None = None, level: int = 6) -> None:
+        if codec not in (PayloadCodec.RAW, PayloadCodec.ZLIB):
+            raise NotImplementedError(f"Unsupported payload codec {codec}")
+        self.codec = codec
+        self.dictionary = dictionary
+        self.compressor = None
+        if codec == PayloadCodec.ZLIB:
+            options = {"zdict": dictionary} if dictionary else {}
+            self.compressor = zlib.compressobj(level, **options)
+
+    def compress(self, data: bytes) -> bytes | None:
+        """
+        Return the compressed payload, None if it is not smaller than `data`.
+        """
+        if self.compressor is None:
+            return None
+        compressor = self.compressor.copy()
+        compressed = compressor.compress(data) + compressor.flush()
+        return compressed if len(compressed) < len(data) else None
+
+
+def dictionary_checksum(dictionary: bytes) -> int:
+    """
+    The id zlib records in streams compressed with `dictionary`.
+    """
+    return zlib.adler32(dictionary)
+
+
+@functools.lru_cache(maxsize=16)
+def dictionary_decompressor(dictionary: bytes):
+    return zlib.decompressobj(zdict=dictionary)
+
+
+def decompress_payload(data: bytes, codec: PayloadCodec, dictionary: Callable[[int], bytes]) -> bytes:
+    """
+    Restore a payload stored with `codec`, `dictionary` returns the preset dictionary of a checksum.
+    """
+    if codec == PayloadCodec.RAW:
+        return data
+    if codec == PayloadCodec.ZLIB:
+        # FDICT flag, the dictionary checksum follows the 2 bytes header
+        if len(data) > 6 and data[1] & 0x20:
+            decompressor = dictionary_decompressor(dictionary(int.from_bytes(data[2:6], "big"))).copy()
+            return decompressor.decompress(data) + decompressor.flush()
+        return zlib.decompress(data)
+    raise NotImplementedError(f"Unsupported payload codec {codec}")
+
+
+def train_payload_dictionary(
+    samples: Iterable[bytes],
+    size: int = MAX_DICTIONARY_SIZE,
+    segment_size: int = 64,
+    kmer_size: int = 8,
+) -> bytes:
+    """
+    Build a zlib preset dictionary from sample payloads: segments covering the k-mers shared by
+    most samples are picked greedily, k-mers already covered no longer counting. The best segments
+    end up last, where zlib reaches them with the shortest distances.
+    """
+    samples = [bytes(sample) for sample in samples if len(sample) >= kmer_size]
+    # in how many samples each k-mer appears
+    frequencies: collections.Counter[bytes] = collections.Counter()
+    for sample in samples:
+        frequencies.update({sample[i : i + kmer_size] for i in range(len(sample) - kmer_size + 1)})
+    covered: set[bytes] = set()
+
+    def kmers(segment: bytes) -> set[bytes]:
+        return {segment[i : i + kmer_size] for i in range(len(segment) - kmer_size + 1)}
+
+    def score(segment: bytes) -> int:
+        return sum(frequencies[kmer] for kmer in kmers(segment) if frequencies[kmer] > 1 and kmer not in covered)
+
+    segments = set()
+    for sample in samples:
+        for start in range(0, max(len(sample) - segment_size, 0) + 1, max(segment_size // 2, 1)):
+            segments.add(sample[start : start + segment_size])
+    heap = [(-score(segment), segment) for segment in segments]
+    heapq.heapify(heap)
+
+    chosen = []
+    total = 0
+    while heap and total < size:
+        _, segment = heapq.heappop(heap)
+        # scores only decrease, so a rescored segment still at the top is the best one
+        current = score(segment)
+        if current == 0:
+            continue
+        if heap and current < -heap[0][0]:
+            heapq.heappush(heap, (-current, segment))
+            continue
+        chosen.append(segment)
+        total += len(segment)
+        covered.update(kmers(segment))
+    return b"".join(reversed(chosen))[-size:]
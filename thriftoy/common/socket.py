@@ -15,10 +15,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import logging
 import socket
 
-from thriftpy2.transport.socket import TSocket
+from thriftpy2.transport.socket import TServerSocket, TSocket
+
+from ..utils.object_pool import ObjectPool
 
 
 class TSimpleSocket(TSocket):
@@ -57,3 +60,84 @@ class TSimpleSocket(TSocket):
         if self.sock and self.local_host:
             logging.info("ThriftSocket: bind socket on %s", self.local_host)
             self.sock.bind((self.local_host, 0))
+
+
+def find_socket(trans):
+    """
+    The transport exposing the socket as `sock` under a stack of transports: the `TSocket`, or a cython
+    transport which keeps its inner transport private and forwards `sock`.
+    """
+    while trans is not None and not hasattr(trans, "sock"):
+        trans = getattr(trans, "_trans", None)
+    return trans
+
+
+def is_socket_open(tsocket) -> bool:
+    """
+    Whether a connection can be reused: still open on both ends, with no unread bytes left.
+    `tsocket` is a `TSocket` or a transport found by `find_socket`.
+    """
+    sock = tsocket.sock if tsocket is not None else None
+    if sock is None:
+        return False
+    timeout = sock.gettimeout()
+    try:
+        sock.settimeout(0)
+        # b"" when the peer closed the connection, data when replies were left unread
+        sock.recv(1, socket.MSG_PEEK)
+        return False
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+    finally:
+        try:
+            sock.settimeout(timeout)
+        except OSError:
+            pass
+
+
+def open_socket(**options) -> TSimpleSocket:
+    tsocket = TSimpleSocket(**options)
+    tsocket.open()
+    return tsocket
+
+
+def make_socket_pool(remote_host: str, remote_port: int, pool_size: int = 8, socket_timeout=3000, **options):
+    """
+    Pool of connected `TSimpleSocket`, validated on checkout.
+    `options` are those of `TSimpleSocket` and `ObjectPool`.
+    """
+    socket_options = {
+        key: options.pop(key) for key in ("connect_timeout", "socket_family", "local_host") if key in options
+    }
+    creator = functools.partial(
+        open_socket, remote_host=remote_host, remote_port=remote_port, socket_timeout=socket_timeout, **socket_options
+    )
+    return ObjectPool(creator, pool_size, validator=is_socket_open, **options)
+
+
+class TReusePortServerSocket(TServerSocket):
+    """
+    `TServerSocket` with SO_REUSEPORT, so several processes can listen on the same port.
+
+    `accept` wakes up every `accept_interval` seconds: a signal delivered to another thread of the
+    process only runs its python handler once the main thread does, which a blocking accept never would.
+    """
+
+    accept_interval = 0.5
+
+    def _init_sock(self):
+        super()._init_sock()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+    def listen(self):
+        super().listen()
+        self.sock.settimeout(self.accept_interval)
+
+    def accept(self):
+        while True:
+            try:
+                return super().accept()
+            except TimeoutError:
+                pass
@@ -75,3 +75,8 @@ class TransportType(str, Enum):
             case TransportType.BUFFERED:
                 return TBufferedTransportFactory()
         raise Exception("TransportType: unknow value %s", str(self.value))
+
+
+class PayloadCodec(str, Enum):
+    RAW = "raw"
+    ZLIB = "zlib"  # with an optional preset dictionary
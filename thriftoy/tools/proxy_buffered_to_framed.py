@@ -25,36 +25,44 @@ from thriftpy2.transport.framed import TFramedTransport
 from ..common.memory_wrapped_transport import TMemoryWrappedTransportFactory
 from ..common.message import TMessage
 from ..common.message_extracted_processor import TFramedTransportHook, TMessageExtractedProcessor
+from ..common.socket import make_socket_pool
 from ..common.types import ProtocolType, TransportType
 
 
 class ProxyProcessor(TMessageExtractedProcessor):
-    def __init__(self, to_host: str, to_port: int) -> None:
+    """
+    Forward every message to `to_host:to_port` framed, over connections kept in a pool, and send
+    the reply back unframed.
+    """
+
+    def __init__(self, to_host: str, to_port: int, pool_size: int = 8) -> None:
         self.to_host = to_host
         self.to_port = to_port
+        self.sockets = make_socket_pool(to_host, to_port, pool_size=pool_size)
         super().__init__(TransportType.BUFFERED)
 
     def handle_message(self, message: TMessage, iprot, oprot):
-        to_socket = TSocket(self.to_host, self.to_port)
-        to_otrans = TFramedTransportHook(TFramedTransport(to_socket))
-        to_otrans.open()
-        to_otrans.write(message.data)
-        to_otrans.flush()
+        # a connection failing mid-call is discarded rather than returned to the pool
+        with self.sockets.borrow() as to_socket:
+            to_otrans = TFramedTransport(to_socket)
+            to_otrans.write(message.data)
+            to_otrans.flush()
 
-        to_itrans = TFramedTransport(to_socket)
-        to_itrans.read(4)
+            # reads the whole reply frame, so the connection is left clean for the next message
+            to_itrans = TFramedTransportHook(TFramedTransport(to_socket))
+            to_itrans.read(4)
         from_socket: TSocket = oprot.trans._trans
-        from_socket.write(to_otrans.get_raw_data()[4:])
+        from_socket.write(to_itrans.get_raw_data()[4:])
 
 
 app = typer.Typer()
 
 
 @app.command()
-def main(host: str = "0.0.0.0", port: int = 6000, to_host: str = "0.0.0.0", to_port: int = 6001):
+def main(host: str = "0.0.0.0", port: int = 6000, to_host: str = "0.0.0.0", to_port: int = 6001, pool_size: int = 8):
     logging.info(f"start: {host}:{port} -> {to_host}:{to_port}")
     server_socket = TServerSocket(host=host, port=port, client_timeout=10000)
-    processor = ProxyProcessor(to_host=to_host, to_port=to_port)
+    processor = ProxyProcessor(to_host=to_host, to_port=to_port, pool_size=pool_size)
     server = TThreadedServer(
         processor=processor,
         trans=server_socket,
@@ -15,7 +15,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
 import logging
+import multiprocessing
+import os
+import signal
 import threading
 import time
 from datetime import datetime
@@ -26,10 +30,32 @@ import sqlmodel
 import typer
 from thriftpy2.rpc import TThreadedServer
 from thriftpy2.transport import TServerSocket
+from typer.core import TyperGroup
 
-from ..common.message import TMessage
+from ..common.async_server import TAsyncMessageExtractedServer
+from ..common.capture_log import CaptureLogReader, CaptureLogWriter
+from ..common.message import (
+    TConnection,
+    TMessage,
+    check_message_schema,
+    create_message_indexes,
+    upgrade_message_schema,
+)
 from ..common.message_extracted_processor import TMessageExtractedProcessor
-from ..common.types import ProtocolType, TransportType
+from ..common.message_filter import TMessageFilter, parse_method_values
+from ..common.message_query import sample_messages
+from ..common.message_writer import (
+    CAPTURE_TABLES,
+    TMessageBatchWriter,
+    TMessageLogBatchWriter,
+    TMessageRotatingBatchWriter,
+    TMessageSpillFile,
+    enable_sqlite_wal,
+)
+from ..common.metrics import CallbackCounter, Counter, Gauge, Histogram, MetricsRegistry, MetricsServer
+from ..common.payload_codec import MAX_DICTIONARY_SIZE, PayloadCompressor, train_payload_dictionary
+from ..common.socket import TReusePortServerSocket
+from ..common.types import PayloadCodec, ProtocolType, TransportType
 
 
 class StorageType(str, Enum):
@@ -38,6 +64,11 @@ class StorageType(str, Enum):
     JSON = "json"
 
 
+class ServerType(str, Enum):
+    THREADED = "threaded"
+    ASYNCIO = "asyncio"
+
+
 class TMessageDumpProcessor(TMessageExtractedProcessor):
     def __init__(
         self,
@@ -46,8 +77,15 @@ class TMessageDumpProcessor(TMessageExtractedProcessor):
         save_size_limit=-1,
         save_time_limit=-1,
         monitor_step_duration=10,
+        batch_size=256,
+        linger_ms=50,
+        writer: TMessageBatchWriter | None = None,
+        message_filter: TMessageFilter | None = None,
     ) -> None:
         self.engine = engine
+        if writer is None:
+            writer = TMessageBatchWriter(engine, batch_size=batch_size, linger_ms=linger_ms)
+        self.writer = writer
         self.start_time = datetime.now()
         self.saved_size = 0
         self.last_check_saved_size = 0
@@ -55,9 +93,60 @@ class TMessageDumpProcessor(TMessageExtractedProcessor):
         self.save_time_limit = save_time_limit
         self.monitor_step_duration = monitor_step_duration
         self.monitor_stop = False
+        self.active_connections = 0
+        self.connections_lock = threading.Lock()
+        super().__init__(transport_type, message_filter=message_filter)
+        self.setup_metrics()
         self.monitor_thread = threading.Thread(target=self.monitor)
-        self.monitor_thread.start()
-        super().__init__(transport_type)
+        if monitor_step_duration > 0:
+            self.monitor_thread.start()
+
+    def setup_metrics(self):
+        self.registry = MetricsRegistry()
+        self.messages_total = self.registry.register(
+            Counter("thriftoy_capture_messages_total", "Captured messages", ("method",))
+        )
+        self.bytes_total = self.registry.register(
+            Counter("thriftoy_capture_bytes_total", "Captured payload bytes", ("method",))
+        )
+        self.extract_seconds = self.registry.register(
+            Histogram("thriftoy_capture_extract_seconds", "Latency from message begin to handing it to storage")
+        )
+        self.registry.register(self.writer.commit_seconds)
+        self.registry.register(
+            Gauge("thriftoy_capture_active_connections", "Open client connections", lambda: self.active_connections)
+        )
+        self.registry.register(
+            Gauge("thriftoy_capture_pending_messages", "Messages waiting for storage", lambda: self.writer.pending_size)
+        )
+        self.registry.register(
+            CallbackCounter(
+                "thriftoy_capture_filtered_total",
+                "Messages rejected by the method filter",
+                lambda: self.message_filter.dropped_size if self.message_filter else 0,
+            )
+        )
+        self.registry.register(
+            CallbackCounter(
+                "thriftoy_capture_spilled_total", "Messages spilled to disk", lambda: self.writer.spilled_size
+            )
+        )
+        self.registry.register(
+            CallbackCounter(
+                "thriftoy_capture_dropped_total", "Messages dropped by storage", lambda: self.writer.dropped_size
+            )
+        )
+        self.registry.register(
+            CallbackCounter("thriftoy_capture_written_total", "Messages persisted", lambda: self.writer.written_size)
+        )
+
+    def on_connection_open(self):
+        with self.connections_lock:
+            self.active_connections += 1
+
+    def on_connection_close(self):
+        with self.connections_lock:
+            self.active_connections -= 1
 
     def set_close_server_cb(self, close_server_cb):
         self.close_server_cb = close_server_cb
@@ -66,12 +155,19 @@ class TMessageDumpProcessor(TMessageExtractedProcessor):
         while not self.monitor_stop:
             elapsed = (datetime.now() - self.start_time).total_seconds()
             qps = (self.saved_size - self.last_check_saved_size) / self.monitor_step_duration
+            filtered = self.message_filter.dropped_size if self.message_filter else 0
             logging.info(
-                "elapsed %ds(%ds), saved: %d(%d), qps: %d",
+                "elapsed %ds(%ds), saved: %d(%d), filtered: %d, pending: %d, spilled: %d, dropped: %d, written: %d, "
+                "qps: %d",
                 elapsed,
                 self.save_time_limit,
                 self.saved_size,
                 self.save_size_limit,
+                filtered,
+                self.writer.pending_size,
+                self.writer.spilled_size,
+                self.writer.dropped_size,
+                self.writer.written_size,
                 int(qps),
             )
             self.last_check_saved_size = self.saved_size
@@ -91,10 +187,34 @@ class TMessageDumpProcessor(TMessageExtractedProcessor):
     def handle_message(self, message: TMessage, iprot, oprot):
         logging.debug("[handle_message]: method=%s, size=%d", message.method, len(message.data))
         self.saved_size += 1
+        self.messages_total.inc(1, message.method)
+        self.bytes_total.inc(len(message.data), message.method)
+        self.extract_seconds.observe((time.time_ns() - message.timestamp) / 1e9)
         self.check_stop()
-        with sqlmodel.Session(self.engine) as session:
-            session.add(message)
-            session.commit()
+        self.writer.put(message)
+
+    def close(self):
+        self.monitor_stop = True
+        self.writer.close()
+        logging.info(
+            "writer closed, spilled: %d, dropped: %d, written: %d",
+            self.writer.spilled_size,
+            self.writer.dropped_size,
+            self.writer.written_size,
+        )
+
+
+class TDumpThreadedServer(TThreadedServer):
+    """
+    `TThreadedServer` reporting connection open/close to the processor.
+    """
+
+    def handle(self, client):
+        self.processor.on_connection_open()
+        try:
+            super().handle(client)
+        finally:
+            self.processor.on_connection_close()
 
 
 def startDumpService(
@@ -103,14 +223,29 @@ def startDumpService(
     processor,
     protocol_type: ProtocolType = ProtocolType.BINARY,
     transport_type: TransportType = TransportType.FRAMED,
+    server_type: ServerType = ServerType.THREADED,
+    reuse_port: bool = False,
 ):
-    server_socket = TServerSocket(host=host, port=port, client_timeout=10000)
-    server = TThreadedServer(
-        processor=processor,
-        trans=server_socket,
-        itrans_factory=transport_type.get_factory(),
-        iprot_factory=protocol_type.get_factory(),
-    )
+    if server_type == ServerType.ASYNCIO:
+        server = TAsyncMessageExtractedServer(
+            processor,
+            host,
+            port,
+            protocol_type=protocol_type,
+            transport_type=transport_type,
+            reuse_port=reuse_port,
+        )
+    else:
+        if reuse_port:
+            server_socket = TReusePortServerSocket(host=host, port=port, client_timeout=10000)
+        else:
+            server_socket = TServerSocket(host=host, port=port, client_timeout=10000)
+        server = TDumpThreadedServer(
+            processor=processor,
+            trans=server_socket,
+            itrans_factory=transport_type.get_factory(),
+            iprot_factory=protocol_type.get_factory(),
+        )
 
     def close_server():
         server.close()
@@ -120,7 +255,224 @@ def startDumpService(
     server.serve()
 
 
-app = typer.Typer()
+def create_dump_processor(
+    db_path: Path,
+    dump_limit: int,
+    transport_type: TransportType,
+    storage_type: StorageType,
+    segment_size_mb: int,
+    clean_db: bool,
+    batch_size: int,
+    linger_ms: int,
+    verbose: bool,
+    max_pending_messages: int = 65536,
+    max_pending_mb: int = 256,
+    spill: bool = True,
+    spill_dir: Path | None = None,
+    max_spill_mb: int = 4096,
+    rotate_size_mb: int = 0,
+    rotate_messages: int = 0,
+    rotate_seconds: int = 0,
+    metrics_port: int = 0,
+    message_filter: TMessageFilter | None = None,
+    dedup: bool = False,
+    codec: PayloadCodec = PayloadCodec.RAW,
+    dictionary: Path | None = None,
+) -> TMessageDumpProcessor:
+    writer_options = dict(
+        batch_size=batch_size,
+        linger_ms=linger_ms,
+        max_pending_size=max_pending_messages,
+        max_pending_bytes=max_pending_mb * 1024 * 1024,
+        spill_file=TMessageSpillFile(spill_dir, max_size=max_spill_mb * 1024 * 1024) if spill else None,
+    )
+    compressor = None
+    if codec != PayloadCodec.RAW:
+        compressor = PayloadCompressor(codec, dictionary.read_bytes() if dictionary else None)
+    if storage_type == StorageType.SQLITE:
+        writer = TMessageRotatingBatchWriter(
+            db_path,
+            rotate_size=rotate_size_mb * 1024 * 1024,
+            rotate_messages=rotate_messages,
+            rotate_seconds=rotate_seconds,
+            clean=clean_db,
+            echo=verbose,
+            dedup=dedup,
+            compressor=compressor,
+            **writer_options,
+        )
+    elif storage_type == StorageType.DIRECTORY:
+        if dedup or codec != PayloadCodec.RAW:
+            raise NotImplementedError(f"Unsupported dedup or payload codec for storage type {storage_type}")
+        if clean_db:
+            for path in db_path.glob("segment-*"):
+                path.unlink()
+        log = CaptureLogWriter(db_path, segment_size=segment_size_mb * 1024 * 1024)
+        writer = TMessageLogBatchWriter(log, **writer_options)
+    else:
+        raise NotImplementedError(f"Unsupported storage type {storage_type}")
+
+    return TMessageDumpProcessor(
+        None,
+        save_size_limit=dump_limit,
+        transport_type=transport_type,
+        batch_size=batch_size,
+        linger_ms=linger_ms,
+        writer=writer,
+        message_filter=message_filter,
+        # the metrics endpoint replaces the monitor log
+        monitor_step_duration=0 if metrics_port else 10,
+    )
+
+
+def runDumpService(
+    db_path: Path,
+    listen_host: str,
+    listen_port: int,
+    protocol_type: ProtocolType,
+    transport_type: TransportType,
+    server_type: ServerType,
+    reuse_port: bool = False,
+    **processor_options,
+):
+    processor = create_dump_processor(db_path, transport_type=transport_type, **processor_options)
+    metrics_server = None
+    if processor_options.get("metrics_port"):
+        metrics_server = MetricsServer(processor.registry, port=processor_options["metrics_port"])
+        metrics_server.start()
+    try:
+        startDumpService(
+            listen_host,
+            listen_port,
+            processor,
+            transport_type=transport_type,
+            protocol_type=protocol_type,
+            server_type=server_type,
+            reuse_port=reuse_port,
+        )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        processor.close()
+        if metrics_server is not None:
+            metrics_server.close()
+
+
+def run_dump_worker(db_path: Path, **options):
+    """
+    `runDumpService` in a `--workers` process, stopped by SIGINT or SIGTERM as by Ctrl-C.
+    """
+
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        # only the first signal stops the worker, later ones must not interrupt the final flush
+        if not stopping.is_set():
+            stopping.set()
+            raise KeyboardInterrupt
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    runDumpService(db_path, **options)
+
+
+def wait_workers(processes: list[multiprocessing.Process], stop_timeout: float):
+    """
+    Wait for the workers, forwarding SIGINT and SIGTERM to them and killing those still running
+    `stop_timeout` seconds after.
+    """
+    stopping = threading.Event()
+
+    def forward(signum, frame):
+        if not stopping.is_set():
+            stopping.set()
+            for process in processes:
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGTERM)
+
+    handlers = {signum: signal.signal(signum, forward) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        while any(process.is_alive() for process in processes) and not stopping.wait(0.5):
+            pass
+        if stopping.is_set():
+            deadline = time.monotonic() + stop_timeout
+            for process in processes:
+                process.join(max(deadline - time.monotonic(), 0))
+                if process.is_alive():
+                    logging.warning("worker %d did not stop in %ss, killing it", process.pid, stop_timeout)
+                    process.kill()
+        for process in processes:
+            process.join()
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+
+def shard_path(db_path: Path, shard: int) -> Path:
+    return db_path.with_name(f"{db_path.stem}.shard-{shard}{db_path.suffix}")
+
+
+def iter_shard_messages(path: Path, storage_type: StorageType):
+    if storage_type == StorageType.SQLITE:
+        engine = sqlmodel.create_engine(f"sqlite:///{path}")
+        check_message_schema(engine)
+        with sqlmodel.Session(engine) as session:
+            statement = sqlmodel.select(TMessage).order_by(TMessage.timestamp, TMessage.id)
+            for message in session.exec(statement.execution_options(yield_per=1024)):
+                connection = None
+                if message.connection is not None:
+                    connection = TConnection(**message.connection.model_dump(exclude={"id"}))
+                # blob ids are per shard, the payload is restored on load
+                exclude = {"id", "connection_id", "blob_id", "codec"}
+                yield TMessage(**message.model_dump(exclude=exclude), connection=connection)
+    elif storage_type == StorageType.DIRECTORY:
+        with CaptureLogReader(path) as reader:
+            for record in reader:
+                yield record.to_message()
+    else:
+        raise NotImplementedError(f"Unsupported storage type {storage_type}")
+
+
+def merge_shards(
+    shards: list[Path],
+    output: Path,
+    storage_type: StorageType = StorageType.SQLITE,
+    batch_size: int = 1024,
+    dedup: bool = False,
+) -> int:
+    """
+    Merge capture shards into one corpus ordered by capture time, return how many messages were written.
+    Raise `RuntimeError` if some could not be written.
+    """
+    messages = heapq.merge(*[iter_shard_messages(path, storage_type) for path in shards], key=lambda m: m.timestamp)
+    if storage_type == StorageType.SQLITE:
+        engine = enable_sqlite_wal(sqlmodel.create_engine(f"sqlite:///{output}"))
+        sqlmodel.SQLModel.metadata.create_all(engine, tables=CAPTURE_TABLES)
+        writer = TMessageBatchWriter(engine, batch_size=batch_size, dedup=dedup)
+    else:
+        writer = TMessageLogBatchWriter(CaptureLogWriter(output), batch_size=batch_size)
+    count = 0
+    for message in messages:
+        writer.put(message)
+        count += 1
+    writer.close()
+    if writer.dropped_size:
+        raise RuntimeError(f"Merged only {writer.written_size} of {count} messages into {output}, see the errors above")
+    return writer.written_size
+
+
+class DefaultMainGroup(TyperGroup):
+    """
+    Run `main` when the first argument is not a subcommand, so `thrift-dump <db> ...` keeps working.
+    """
+
+    def parse_args(self, ctx, args: list[str]) -> list[str]:
+        if args and not args[0].startswith("-") and args[0] not in self.commands:
+            args = ["main", *args]
+        return super().parse_args(ctx, args)
+
+
+app = typer.Typer(cls=DefaultMainGroup)
 
 
 @app.command()
@@ -131,22 +483,159 @@ def main(
     dump_limit: int = 100,
     transport_type: TransportType = TransportType.FRAMED,
     protocol_type: ProtocolType = ProtocolType.BINARY,
+    server: ServerType = ServerType.THREADED,
+    storage_type: StorageType = StorageType.SQLITE,
+    segment_size_mb: int = 256,
+    workers: int = 1,
+    stop_timeout: float = 30,
+    allow_method: list[str] | None = None,
+    deny_method: list[str] | None = None,
+    sample: list[str] | None = None,
+    max_rate: list[str] | None = None,
     clean_db: bool = False,
+    batch_size: int = 256,
+    linger_ms: int = 50,
+    max_pending_messages: int = 65536,
+    max_pending_mb: int = 256,
+    spill: bool = True,
+    spill_dir: Path | None = None,
+    max_spill_mb: int = 4096,
+    rotate_size_mb: int = 0,
+    rotate_messages: int = 0,
+    rotate_seconds: int = 0,
+    metrics_port: int = 0,
+    dedup: bool = False,
+    codec: PayloadCodec = PayloadCodec.RAW,
+    dictionary: Path | None = None,
     verbose: bool = False,
 ):
     logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.INFO)
     logging.info("start dumpping server on %s:%s", listen_host, listen_port)
 
-    storage_engine = sqlmodel.create_engine(f"sqlite:///{db_path}", echo=verbose)
-    if clean_db:
-        sqlmodel.SQLModel.metadata.drop_all(storage_engine)
-    sqlmodel.SQLModel.metadata.create_all(storage_engine, tables=[TMessage.__table__])
-
-    processor = TMessageDumpProcessor(storage_engine, save_size_limit=dump_limit, transport_type=transport_type)
-    startDumpService(
-        listen_host,
-        listen_port,
-        processor,
-        transport_type=transport_type,
+    message_filter = None
+    if allow_method or deny_method or sample or max_rate:
+        message_filter = TMessageFilter(
+            allow_methods=allow_method,
+            deny_methods=deny_method,
+            sample_ratios=parse_method_values(sample or []),
+            # every worker has its own rate limiter, so each keeps its share of the rate
+            max_rates={method: rate / max(workers, 1) for method, rate in parse_method_values(max_rate or []).items()},
+        )
+    options = dict(
+        listen_host=listen_host,
+        listen_port=listen_port,
         protocol_type=protocol_type,
+        transport_type=transport_type,
+        server_type=server,
+        dump_limit=dump_limit,
+        storage_type=storage_type,
+        segment_size_mb=segment_size_mb,
+        clean_db=clean_db,
+        batch_size=batch_size,
+        linger_ms=linger_ms,
+        verbose=verbose,
+        max_pending_messages=max_pending_messages,
+        max_pending_mb=max_pending_mb,
+        spill=spill,
+        spill_dir=spill_dir,
+        max_spill_mb=max_spill_mb,
+        rotate_size_mb=rotate_size_mb,
+        rotate_messages=rotate_messages,
+        rotate_seconds=rotate_seconds,
+        metrics_port=metrics_port,
+        message_filter=message_filter,
+        dedup=dedup,
+        codec=codec,
+        dictionary=dictionary,
+    )
+    if workers <= 1:
+        runDumpService(db_path, **options)
+        return
+
+    options["reuse_port"] = True
+    processes = []
+    for i in range(workers):
+        # every worker serves its own metrics endpoint on metrics_port + i
+        worker_options = options | {"metrics_port": metrics_port + i if metrics_port else 0}
+        processes.append(
+            multiprocessing.Process(target=run_dump_worker, args=(shard_path(db_path, i),), kwargs=worker_options)
+        )
+    for process in processes:
+        process.start()
+    wait_workers(processes, stop_timeout)
+    logging.info("shards: %s", ", ".join(shard_path(db_path, i).as_posix() for i in range(workers)))
+
+
+@app.command()
+def merge(
+    output: Path,
+    shards: list[Path],
+    storage_type: StorageType = StorageType.SQLITE,
+    batch_size: int = 1024,
+    dedup: bool = False,
+):
+    logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.INFO)
+    count = merge_shards(shards, output, storage_type=storage_type, batch_size=batch_size, dedup=dedup)
+    logging.info("merged %d messages from %d shards into %s", count, len(shards), output)
+
+
+@app.command()
+def upgrade(db_paths: list[Path]):
+    """
+    Bring sqlite captures of older versions up to the current schema, in place.
+    """
+    logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.INFO)
+    for db_path in db_paths:
+        start = time.time()
+        engine = sqlmodel.create_engine(f"sqlite:///{db_path}")
+        upgrade_message_schema(engine)
+        engine.dispose()
+        logging.info("upgraded %s in %.1fs", db_path, time.time() - start)
+
+
+@app.command()
+def index(db_paths: list[Path], analyze: bool = True):
+    """
+    Build the query indexes on sqlite captures taken before they were created at close, upgrading them first.
+    """
+    logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.INFO)
+    for db_path in db_paths:
+        start = time.time()
+        engine = sqlmodel.create_engine(f"sqlite:///{db_path}")
+        create_message_indexes(engine, analyze=analyze)
+        engine.dispose()
+        logging.info("indexed %s in %.1fs", db_path, time.time() - start)
+
+
+@app.command()
+def train_dictionary(
+    output: Path,
+    db_paths: list[Path],
+    samples: int = 4096,
+    size: int = MAX_DICTIONARY_SIZE,
+    method: list[str] | None = None,
+    seed: int | None = None,
+):
+    """
+    Train a zlib preset dictionary for `--codec zlib --dictionary` from payloads sampled in captures.
+    """
+    logging.basicConfig(format="%(levelname)s:%(message)s", level=logging.INFO)
+    payloads = []
+    for db_path in db_paths:
+        engine = sqlmodel.create_engine(f"sqlite:///{db_path}")
+        payloads += sample_messages(engine, samples // len(db_paths), columns=["data"], seed=seed, method=method)
+        engine.dispose()
+    dictionary = train_payload_dictionary(payloads, size=size)
+    output.write_bytes(dictionary)
+
+    raw = sum(len(payload) for payload in payloads)
+    plain = PayloadCompressor(PayloadCodec.ZLIB)
+    primed = PayloadCompressor(PayloadCodec.ZLIB, dictionary)
+    compressed = [sum(len(compressor.compress(p) or p) for p in payloads) for compressor in (plain, primed)]
+    logging.info(
+        "trained %d bytes dictionary from %d payloads, ratio %.2f without and %.2f with it",
+        len(dictionary),
+        len(payloads),
+        raw / max(compressed[0], 1),
+        raw / max(compressed[1], 1),
     )
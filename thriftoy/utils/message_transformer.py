@@ -15,51 +15,483 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import functools
 import logging
 import multiprocessing
+import os
 import queue
-from collections.abc import Callable
+import threading
+import time
+from collections.abc import Callable, Iterator
 from typing import Any
 
 import sqlalchemy
 import sqlmodel
 
-from ..common.message import TMessage
+from ..common.message import TMessage, check_message_schema, iter_messages
+from .payload_arena import PayloadArena, TMessageDescriptor, load_messages
+
+
+class TTransformCheckpoint(sqlmodel.SQLModel, table=True):
+    """
+    High-water mark of a transform in its target database: messages up to `last_id` are done.
+    """
+
+    name: str = sqlmodel.Field(primary_key=True)
+    last_id: int
+    updated: int = 0  # time of the last commit in ns
+
+
+def read_checkpoint(session: sqlmodel.Session, name: str | None) -> int | None:
+    """
+    Return the first message id after the `name` mark, None to start from the beginning.
+    The checkpoint table is created in the target on first use.
+    """
+    if name is None:
+        return None
+    TTransformCheckpoint.__table__.create(session.get_bind(), checkfirst=True)
+    checkpoint = session.get(TTransformCheckpoint, name)
+    return checkpoint.last_id + 1 if checkpoint is not None else None
+
+
+def write_checkpoint(session: sqlmodel.Session, name: str | None, last_id: int | None):
+    if name is not None and last_id is not None:
+        session.merge(TTransformCheckpoint(name=name, last_id=last_id, updated=time.time_ns()))
+
+
+@functools.lru_cache(maxsize=8)
+def get_source_engine(url: str) -> sqlalchemy.Engine:
+    """
+    The engine a worker reads shards through, read-only for sqlite files.
+    """
+    source_url = sqlalchemy.make_url(url)
+    if source_url.get_backend_name() == "sqlite" and source_url.database:
+        source_url = source_url.set(database=f"file:{source_url.database}", query={"mode": "ro", "uri": "true"})
+    return sqlmodel.create_engine(source_url)
+
+
+def transform_shard(
+    transform: Callable[[TMessage], Any], url: str, chunk_size: int, bounds: tuple[int, int]
+) -> tuple[int, int, list]:
+    start_id, end_id = bounds
+    count = 0
+    outputs = []
+    for message in iter_messages(get_source_engine(url), start_id=start_id, end_id=end_id, chunk_size=chunk_size):
+        count += 1
+        outputs.extend(transform(message))
+    return end_id - 1, count, outputs
+
+
+def transform_batch(
+    transform: Callable[[TMessage], Any], name: str, descriptors: list[TMessageDescriptor]
+) -> list[tuple[bool, Any]]:
+    """
+    Transform every message of a batch, returning (True, result) or (False, exception) for each.
+    """
+    outcomes = []
+    for message in load_messages(name, descriptors):
+        try:
+            outcomes.append((True, transform(message)))
+        except Exception as e:
+            outcomes.append((False, e))
+    return outcomes
+
+
+def transform_chunk(
+    transform: Callable[[TMessage], Any], name: str, chunk: tuple[int | None, list[TMessageDescriptor]]
+) -> tuple[int | None, int, int, list]:
+    slot, descriptors = chunk
+    outputs = []
+    for message in load_messages(name, descriptors):
+        outputs.extend(transform(message))
+    return slot, descriptors[-1].id, len(descriptors), outputs
 
 
 class MultiProcessStreamingTransformer:
-    def __init__(self, transform: Callable[[TMessage], Any], num_processes=None):
+    """
+    Run `transform` on pushed messages in a process pool, `get` returning their results (or raising
+    their exception) in push order, or as they complete if not `ordered` so that a slow message
+    does not hold back the others.
+
+    Messages are sent `batch_size` at a time, a partial batch being sent by `flush` or by `get`
+    when there is no result yet. With `max_in_flight`, `push` blocks while that many batches are
+    being transformed. Payloads are passed through a shared `PayloadArena`, one slot per batch.
+    `close` sends the last batch and stops the pool, `join` waits for the workers and frees the arena.
+    """
+
+    def __init__(
+        self,
+        transform: Callable[[TMessage], Any],
+        num_processes=None,
+        ordered: bool = True,
+        max_in_flight: int | None = None,
+        batch_size: int = 1,
+        arena_slots: int | None = None,
+        arena_slot_size: int = 1024 * 1024,
+    ):
         self.transform = transform
         self.num_processes = num_processes
+        self.ordered = ordered
+        self.batch_size = max(batch_size, 1)
+        self.in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        # created first, so that workers share the resource tracker the arena is registered with
+        slots = arena_slots or max_in_flight or 4 * (num_processes or os.cpu_count() or 1)
+        self.arena = PayloadArena(slots, arena_slot_size)
         self.pool = multiprocessing.Pool(num_processes)
-        self.queue = queue.Queue()
+        self.batch: list[TMessage] = []
+        self.next_task = 0
+        self.outstanding = 0  # batches submitted and not returned yet
+        # ids of the outstanding batches in submission order, when `ordered`
+        self.submitted: collections.deque[int] = collections.deque()
+        # (task id, outcomes) of completed batches, filled by the pool result thread
+        self.completed: queue.Queue = queue.Queue()
+        self.done: dict[int, list] = {}
+        self.ready: collections.deque = collections.deque()
+        self.pending = 0  # messages pushed and not returned by `get`
+        self.closed = False
 
     def push(self, message: TMessage):
-        self.queue.put(self.pool.apply_async(self.transform, (message,)))
+        if self.closed:
+            raise ValueError("Transformer is closed")
+        self.batch.append(message)
+        self.pending += 1
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        if self.in_flight is not None:
+            self.in_flight.acquire()
+        # payloads beyond the free slots are carried inline
+        slot = self.arena.acquire()
+        descriptors = self.arena.pack(batch, slot)
+        task = self.next_task
+        self.next_task += 1
+        self.outstanding += 1
+        if self.ordered:
+            self.submitted.append(task)
+        self.pool.apply_async(
+            transform_batch,
+            (self.transform, self.arena.name, descriptors),
+            callback=functools.partial(self.complete, task, slot),
+            error_callback=functools.partial(self.fail, task, slot, len(batch)),
+        )
+
+    def complete(self, task: int, slot: int | None, outcomes: list):
+        self.arena.release(slot)
+        if self.in_flight is not None:
+            self.in_flight.release()
+        self.completed.put((task, outcomes))
+
+    def fail(self, task: int, slot: int | None, size: int, error: BaseException):
+        self.complete(task, slot, [(False, error)] * size)
+
+    def get(self, timeout: float | None = None):
+        """
+        Return the next result, raise the exception of its transform, or `queue.Empty` after `timeout`.
+        """
+        if not self.ready:
+            if not self.outstanding:
+                self.flush()
+            if not self.outstanding:
+                raise queue.Empty
+            self.ready.extend(self.next_outcomes(timeout))
+        self.pending -= 1
+        ok, value = self.ready.popleft()
+        if not ok:
+            raise value
+        return value
+
+    def next_outcomes(self, timeout: float | None) -> list:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.ordered and self.submitted[0] in self.done:
+                self.outstanding -= 1
+                return self.done.pop(self.submitted.popleft())
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            task, outcomes = self.completed.get(True, remaining)
+            if not self.ordered:
+                self.outstanding -= 1
+                return outcomes
+            self.done[task] = outcomes
 
-    def get(self):
-        return self.queue.get(True)
+    def results(self) -> Iterator:
+        """
+        Yield the results of every message pushed so far, raising at the first failed transform.
+        """
+        while self.pending:
+            yield self.get()
+
+    def close(self):
+        if not self.closed:
+            self.flush()
+            self.closed = True
+            self.pool.close()
+
+    def join(self):
+        self.pool.join()
+        self.arena.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        self.join()
 
 
 class MultiProcessBatchingTransformer:
-    def __init__(self, transform: Callable[[TMessage], Any], num_processes=None):
+    """
+    Run `transform` over the messages of a capture in a process pool and store the models it
+    returns for each message.
+
+    Messages are sent in chunks of up to `chunk_size`, at most `max_in_flight` chunks being read or
+    transformed at a time, their payloads copied into a shared `PayloadArena` slot of
+    `arena_slot_size` bytes (which also caps the payload bytes of a chunk), so that only small
+    descriptors are pickled.
+    `run` holds every output and commits them at once. `run(streaming=True)` instead commits
+    outputs every `commit_size` as chunks complete, in any order, so memory stays bounded whatever
+    the size of the capture. Progress is logged every `progress_interval` seconds.
+
+    With `sharded`, the parent no longer reads messages: workers are handed ranges of
+    `shard_size` message ids and read them from the source database themselves, so reading
+    scales with `num_processes`. Outputs are still written by the parent alone.
+    """
+
+    def __init__(
+        self,
+        transform: Callable[[TMessage], Any],
+        num_processes=None,
+        chunk_size: int = 256,
+        max_in_flight: int | None = None,
+        commit_size: int = 10000,
+        progress_interval: float = 10,
+        arena_slot_size: int = 4 * 1024 * 1024,
+        shard_size: int = 4096,
+    ):
         self.transform = transform
         self.num_processes = num_processes
+        self.chunk_size = max(chunk_size, 1)
+        self.shard_size = max(shard_size, 1)
+        # enough chunks to keep every worker busy while results are committed
+        self.max_in_flight = max_in_flight or 2 * (num_processes or os.cpu_count() or 1)
+        self.commit_size = max(commit_size, 1)
+        self.progress_interval = progress_interval
+        # created first, so that workers share the resource tracker the arena is registered with
+        self.arena = PayloadArena(self.max_in_flight, arena_slot_size)
         self.pool = multiprocessing.Pool(num_processes)
 
-    def run(self, source_engine: sqlalchemy.Engine, target_engine: sqlalchemy.Engine, limit=None):
+    def imap_bounded(
+        self, func: Callable, tasks: Iterator, ordered: bool = True, release: Callable | None = None
+    ) -> Iterator:
+        """
+        `imap` over `tasks` with at most `max_in_flight` of them taken and not yet returned.
+        `release` is called on each result before the next task may be taken, to free what its task held.
+        """
+        # the pool reads tasks from its task thread as fast as it can, so they are handed out
+        # only once a slot is free
+        slots = threading.Semaphore(self.max_in_flight)
+        stopped = threading.Event()
+
+        def bounded_tasks():
+            while True:
+                slots.acquire()
+                # checked before pulling, a task taken after the consumer left would never be released
+                if stopped.is_set():
+                    return
+                task = next(tasks, None)
+                if task is None:
+                    return
+                yield task
+
+        imap = self.pool.imap if ordered else self.pool.imap_unordered
+        results = imap(func, bounded_tasks())
+        try:
+            for result in results:
+                if release is not None:
+                    release(result)
+                slots.release()
+                yield result
+        finally:
+            # unblock the task thread if the pool is left early
+            stopped.set()
+            slots.release()
+            if release is not None:
+                # and wait for the tasks still in flight, to give back what they hold
+                while True:
+                    try:
+                        release(next(results))
+                    except StopIteration:
+                        break
+                    except Exception:
+                        continue
+
+    def transform_chunks(
+        self, source_engine: sqlalchemy.Engine, limit=None, ordered: bool = True, start_id: int | None = None
+    ) -> Iterator:
+        """
+        Yield the (last message id, number of messages, outputs) of every chunk of the messages
+        from `start_id`, in source order if `ordered`.
+        """
+
+        def chunks():
+            messages = iter_messages(source_engine, start_id=start_id, limit=limit, chunk_size=self.chunk_size)
+            carry = None
+            while True:
+                # up to chunk_size messages whose payloads fit in a slot, at least one
+                chunk = [carry] if carry is not None else []
+                size = len(carry.data) if carry is not None else 0
+                carry = None
+                for message in messages:
+                    if chunk and (len(chunk) >= self.chunk_size or size + len(message.data) > self.arena.slot_size):
+                        carry = message
+                        break
+                    chunk.append(message)
+                    size += len(message.data)
+                if not chunk:
+                    return
+                slot = self.arena.acquire()
+                if slot is None:
+                    logging.warning(
+                        "MultiProcessBatchingTransformer: no free arena slot, %d payloads inline", len(chunk)
+                    )
+                yield slot, self.arena.pack(chunk, slot)
+
+        transform = functools.partial(transform_chunk, self.transform, self.arena.name)
+
+        def release(result):
+            # the slot is back in the arena before the next chunk is packed
+            self.arena.release(result[0])
+
+        for _, last_id, size, outputs in self.imap_bounded(transform, chunks(), ordered, release):
+            yield last_id, size, outputs
+
+    def transform_shards(
+        self, source_engine: sqlalchemy.Engine, limit=None, ordered: bool = True, start_id: int | None = None
+    ) -> Iterator:
+        """
+        Like `transform_chunks` over ranges of `shard_size` message ids, which workers read from
+        their own read-only connection to the source database.
+        """
+        # checked once here rather than by every worker
+        check_message_schema(source_engine)
+        conditions = [] if start_id is None else [TMessage.id >= start_id]
         with sqlmodel.Session(source_engine) as session:
-            statement = sqlmodel.select(TMessage)
+            bounds = sqlmodel.select(sqlalchemy.func.min(TMessage.id), sqlalchemy.func.max(TMessage.id))
+            low, high = session.exec(bounds.where(*conditions)).one()
+            if low is None or (limit is not None and limit <= 0):
+                return
             if limit is not None:
-                statement = statement.limit(limit)
-            messages = self.pool.map(self.transform, session.exec(statement))
-        count = 0
+                last = sqlmodel.select(TMessage.id).where(*conditions).order_by(TMessage.id).offset(limit - 1).limit(1)
+                high = session.exec(last).first() or high
+        ranges = ((start, min(start + self.shard_size, high + 1)) for start in range(low, high + 1, self.shard_size))
+        url = source_engine.url.render_as_string(hide_password=False)
+        transform = functools.partial(transform_shard, self.transform, url, self.chunk_size)
+        yield from self.imap_bounded(transform, ranges, ordered)
+
+    def run(
+        self,
+        source_engine: sqlalchemy.Engine,
+        target_engine: sqlalchemy.Engine,
+        limit=None,
+        streaming: bool = False,
+        sharded: bool = False,
+        checkpoint: str | None = None,
+    ) -> int:
+        """
+        Transform the source messages and return how many were read. With `checkpoint`, only
+        messages after the high-water mark recorded under that name in the target are read, and
+        the mark is committed along with the outputs.
+        """
+        if streaming:
+            return self.run_streaming(source_engine, target_engine, limit, sharded, checkpoint)
+        transform = self.transform_shards if sharded else self.transform_chunks
+        consumed = count = 0
         with sqlmodel.Session(target_engine) as session:
-            for message in messages:
-                count += len(message)
-                session.add_all(message)
+            start_id = read_checkpoint(session, checkpoint)
+            mark = None
+            for last_id, size, outputs in transform(source_engine, limit=limit, start_id=start_id):
+                mark = last_id
+                consumed += size
+                count += len(outputs)
+                session.add_all(outputs)
+            write_checkpoint(session, checkpoint, mark)
             session.commit()
         logging.info("MultiProcessBatchingTransformer: %d messages transformed", count)
+        return consumed
+
+    def run_streaming(
+        self,
+        source_engine: sqlalchemy.Engine,
+        target_engine: sqlalchemy.Engine,
+        limit=None,
+        sharded: bool = False,
+        checkpoint: str | None = None,
+    ) -> int:
+        transform = self.transform_shards if sharded else self.transform_chunks
+        consumed = count = pending = 0
+        start = last_report = time.monotonic()
+        with sqlmodel.Session(target_engine) as session:
+            start_id = read_checkpoint(session, checkpoint)
+            # the mark only moves past chunks whose predecessors are all committed
+            ordered = checkpoint is not None
+            last_id = None
+            for last_id, size, outputs in transform(source_engine, limit=limit, ordered=ordered, start_id=start_id):
+                consumed += size
+                count += len(outputs)
+                pending += len(outputs)
+                session.add_all(outputs)
+                if pending >= self.commit_size:
+                    write_checkpoint(session, checkpoint, last_id)
+                    session.commit()
+                    session.expunge_all()
+                    pending = 0
+                now = time.monotonic()
+                if now - last_report >= self.progress_interval:
+                    last_report = now
+                    logging.info(
+                        "MultiProcessBatchingTransformer: %d messages read, %d transformed, %.0f msg/s",
+                        consumed,
+                        count,
+                        consumed / (now - start),
+                    )
+            write_checkpoint(session, checkpoint, last_id)
+            session.commit()
+        if consumed or checkpoint is None:
+            logging.info(
+                "MultiProcessBatchingTransformer: %d messages transformed from %d in %.1fs",
+                count,
+                consumed,
+                time.monotonic() - start,
+            )
+        return consumed
+
+    def follow(
+        self,
+        source_engine: sqlalchemy.Engine,
+        target_engine: sqlalchemy.Engine,
+        checkpoint: str,
+        sharded: bool = False,
+        poll_interval: float = 1,
+        stop: threading.Event | None = None,
+    ):
+        """
+        Keep transforming the messages appended to a capture still being written, from the
+        `checkpoint` mark, checking for new ones every `poll_interval` seconds once caught up,
+        until `stop` is set.
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            if not self.run_streaming(source_engine, target_engine, sharded=sharded, checkpoint=checkpoint):
+                stop.wait(poll_interval)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.arena.close()
 
 
 def batch_transform(
@@ -68,6 +500,30 @@ def batch_transform(
     transform=Callable[[TMessage], Any],
     num_processes=None,
     limit=None,
+    streaming: bool = False,
+    sharded: bool = False,
+    checkpoint: str | None = None,
+    follow: bool = False,
+    poll_interval: float = 1,
+    **options,
 ):
-    transformer = MultiProcessBatchingTransformer(transform=transform, num_processes=num_processes)
-    transformer.run(source_engine, target_engine, limit=limit)
+    """
+    Transform the messages of `source_engine` into `target_engine`, see `MultiProcessBatchingTransformer`.
+    With `checkpoint` (a name for the transform), a later call resumes after the last message
+    processed. `follow` then keeps transforming new messages until interrupted.
+    """
+    transformer = MultiProcessBatchingTransformer(transform=transform, num_processes=num_processes, **options)
+    try:
+        if follow:
+            if checkpoint is None:
+                raise ValueError("follow requires a checkpoint name")
+            transformer.follow(source_engine, target_engine, checkpoint, sharded=sharded, poll_interval=poll_interval)
+        else:
+            transformer.run(
+                source_engine, target_engine, limit=limit, streaming=streaming, sharded=sharded, checkpoint=checkpoint
+            )
+    except KeyboardInterrupt:
+        if not follow:
+            raise
+    finally:
+        transformer.close()
@@ -15,24 +15,288 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import queue
-from collections.abc import Callable
-from typing import Any
+import contextlib
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from typing import Any, NamedTuple
+
+
+class ObjectPoolStats(NamedTuple):
+    size: int  # objects alive, idle or checked out
+    idle: int
+    hits: int  # checkouts served by an idle object
+    misses: int  # checkouts that had to create one
+    creations: int
+    evictions: int  # objects destroyed because expired, invalid or discarded
+    timeouts: int
+
+
+class PooledObject:
+    __slots__ = ("item", "created", "last_used")
+
+    def __init__(self, item, now: float) -> None:
+        self.item = item
+        self.created = now
+        self.last_used = now
+
+
+def close_object(item):
+    close = getattr(item, "close", None)
+    if callable(close):
+        close()
 
 
 class ObjectPool:
-    def __init__(self, creator: Callable[[], Any], pool_size: int):
-        self.pool = queue.Queue(pool_size)
+    """
+    Pool of reusable objects (connections), keeping up to `pool_size` idle ones.
+
+    `get` returns an idle object or creates one. With `max_size`, at most that many objects are alive
+    at once, `get` then waits up to `checkout_timeout` seconds (None waits forever) for one to be
+    returned and raises `TimeoutError`. Objects taken with `get` go back with `put` or `discard`.
+    Idle objects are checked with `validator` before being handed out. Objects idle for more than
+    `max_idle_seconds` or alive for more than `max_lifetime_seconds` are destroyed with `destroyer`
+    (`close()` by default), `min_size` objects being kept ready. `evict` applies the limits to
+    idle objects, which a daemon thread does every `eviction_interval` seconds if set.
+    """
+
+    def __init__(
+        self,
+        creator: Callable[[], Any],
+        pool_size: int,
+        min_size: int = 0,
+        max_idle_seconds: float | None = None,
+        max_lifetime_seconds: float | None = None,
+        validator: Callable[[Any], bool] | None = None,
+        destroyer: Callable[[Any], None] = close_object,
+        max_size: int | None = None,
+        checkout_timeout: float | None = 30,
+        eviction_interval: float | None = None,
+    ):
         self.creator = creator
+        self.pool_size = max(pool_size, 1)
+        self.max_size = max(max_size, self.pool_size) if max_size is not None else None
+        self.min_size = min(max(min_size, 0), self.pool_size)
+        self.max_idle_seconds = max_idle_seconds
+        self.max_lifetime_seconds = max_lifetime_seconds
+        self.validator = validator
+        self.destroyer = destroyer
+        self.checkout_timeout = checkout_timeout
+
+        self.cond = threading.Condition()
+        # most recently returned last, handed out first to keep the warmest objects in use
+        self.idle: deque[PooledObject] = deque()
+        self.checked_out: dict[int, PooledObject] = {}
+        self.size = 0
+        self.closed = False
+        self.hits = self.misses = self.creations = self.evictions = self.timeouts = 0
+
+        self.fill()
+        self.stop_eviction = threading.Event()
+        if eviction_interval:
+            thread = threading.Thread(target=self.run_eviction, args=(eviction_interval,), daemon=True)
+            thread.start()
+
+    def expired(self, entry: PooledObject, now: float, idle: bool = True) -> bool:
+        if self.max_lifetime_seconds is not None and now - entry.created > self.max_lifetime_seconds:
+            return True
+        return idle and self.max_idle_seconds is not None and now - entry.last_used > self.max_idle_seconds
+
+    def get(self, timeout: float | None = None):
+        """
+        Check an object out, waiting at most `timeout` seconds (`checkout_timeout` if None).
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            expired: list[PooledObject] = []
+            try:
+                entry = self.checkout(deadline, expired)
+            finally:
+                self.destroy(expired)
+            if entry is None:
+                return self.create()
+            if self.validator is None or self.is_valid(entry.item):
+                with self.cond:
+                    self.hits += 1
+                    self.checked_out[id(entry.item)] = entry
+                return entry.item
+            with self.cond:
+                self.size -= 1
+                self.evictions += 1
+                self.cond.notify()
+            self.destroy([entry])
 
-    def get(self):
+    def checkout(self, deadline: float | None, expired: list[PooledObject]) -> PooledObject | None:
+        """
+        Take an idle object, or reserve the creation of one (None). Expired idle objects met are
+        moved to `expired` for the caller to destroy outside the lock.
+        """
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise ValueError("ObjectPool is closed")
+                now = time.monotonic()
+                while self.idle:
+                    entry = self.idle.pop()
+                    if not self.expired(entry, now):
+                        return entry
+                    expired.append(entry)
+                    self.size -= 1
+                    self.evictions += 1
+                if self.max_size is None or self.size < self.max_size:
+                    self.size += 1
+                    self.misses += 1
+                    return None
+                remaining = None if deadline is None else deadline - now
+                if remaining is not None and remaining <= 0:
+                    self.timeouts += 1
+                    raise TimeoutError(f"No object returned in time to ObjectPool, all {self.max_size} are checked out")
+                self.cond.wait(remaining)
+
+    def create(self):
         try:
-            return self.pool.get_nowait()
-        except Exception:
-            return self.creator()
+            item = self.creator()
+        except BaseException:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+        with self.cond:
+            self.creations += 1
+            self.checked_out[id(item)] = PooledObject(item, time.monotonic())
+        return item
 
     def put(self, item):
+        """
+        Return a checked out object, destroyed instead if the pool is closed, already holds `pool_size`
+        idle objects or it outlived its lifetime.
+        """
+        now = time.monotonic()
+        with self.cond:
+            entry = self.checked_out.pop(id(item), None)
+            if entry is None:
+                # not created by this pool, adopt it if there is room
+                if self.max_size is not None and self.size >= self.max_size:
+                    entry = None
+                else:
+                    entry = PooledObject(item, now)
+                    self.size += 1
+            full = len(self.idle) >= self.pool_size
+            if entry is not None and not self.closed and not full and not self.expired(entry, now, idle=False):
+                entry.last_used = now
+                self.idle.append(entry)
+                self.cond.notify()
+                return
+            if entry is not None:
+                self.size -= 1
+                self.evictions += 1
+                self.cond.notify()
+        self.destroy([PooledObject(item, now)])
+
+    def discard(self, item):
+        """
+        Destroy a checked out object that must not be reused, e.g. a connection that failed.
+        """
+        with self.cond:
+            if self.checked_out.pop(id(item), None) is not None:
+                self.size -= 1
+                self.evictions += 1
+                self.cond.notify()
+        self.destroy([PooledObject(item, 0)])
+
+    def resize(self, pool_size: int):
+        """
+        Change how many idle objects are kept, destroying the oldest idle ones beyond it.
+        """
+        with self.cond:
+            self.pool_size = max(pool_size, 1)
+            self.min_size = min(self.min_size, self.pool_size)
+            if self.max_size is not None:
+                self.max_size = max(self.max_size, self.pool_size)
+            extra = [self.idle.popleft() for _ in range(max(len(self.idle) - self.pool_size, 0))]
+            self.size -= len(extra)
+            self.evictions += len(extra)
+        self.destroy(extra)
+
+    @contextlib.contextmanager
+    def borrow(self, timeout: float | None = None) -> Iterator:
+        """
+        Check an object out for the `with` block, discarding it if the block raises.
+        """
+        item = self.get(timeout)
         try:
-            self.pool.put_nowait(item)
+            yield item
+        except BaseException:
+            self.discard(item)
+            raise
+        self.put(item)
+
+    def evict(self):
+        """
+        Destroy the idle objects past their idle time or lifetime, then create objects up to `min_size`.
+        """
+        now = time.monotonic()
+        with self.cond:
+            kept: deque[PooledObject] = deque()
+            expired = []
+            # oldest returned first, so the warmest objects are the ones kept for min_size
+            for entry in self.idle:
+                spare = self.size - len(expired) > self.min_size
+                if self.expired(entry, now, idle=False) or (spare and self.expired(entry, now)):
+                    expired.append(entry)
+                else:
+                    kept.append(entry)
+            self.idle = kept
+            self.size -= len(expired)
+            self.evictions += len(expired)
+        self.destroy(expired)
+        self.fill()
+
+    def fill(self):
+        while True:
+            with self.cond:
+                if self.closed or self.size >= self.min_size:
+                    return
+                self.size += 1
+            self.put(self.create())
+
+    def run_eviction(self, interval: float):
+        while not self.stop_eviction.wait(interval):
+            try:
+                self.evict()
+            except Exception:
+                logging.exception("ObjectPool: eviction failed")
+
+    def is_valid(self, item) -> bool:
+        try:
+            return bool(self.validator(item))
         except Exception:
-            pass
+            return False
+
+    def destroy(self, entries: list[PooledObject]):
+        for entry in entries:
+            try:
+                self.destroyer(entry.item)
+            except Exception:
+                logging.debug("ObjectPool: failed to destroy %r", entry.item, exc_info=True)
+
+    def stats(self) -> ObjectPoolStats:
+        with self.cond:
+            return ObjectPoolStats(
+                self.size, len(self.idle), self.hits, self.misses, self.creations, self.evictions, self.timeouts
+            )
+
+    def close(self):
+        """
+        Destroy the idle objects, those checked out are destroyed when returned.
+        """
+        self.stop_eviction.set()
+        with self.cond:
+            self.closed = True
+            idle, self.idle = list(self.idle), deque()
+            self.size -= len(idle)
+            self.cond.notify_all()
+        self.destroy(idle)
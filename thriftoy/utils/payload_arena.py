@@ -0,0 +1,145 @@
+# Copyright (c) 2022-2024 curoky(cccuroky@gmail.com).
+#
+# This file is part of thriftoy.
+# See https://github.com/curoky/thriftoy for further info.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import functools
+import threading
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+from ..common.message import TConnection, TMessage
+
+
+class TMessageDescriptor(NamedTuple):
+    """
+    A `TMessage` handed to a worker without its payload, found at `offset` in the arena instead.
+    `data` carries the payload inline when it did not fit in a slot.
+    """
+
+    id: int | None
+    method: str
+    type: int
+    seqid: int
+    timestamp: int
+    protocol_type: str
+    transport_type: str
+    connection: tuple | None  # TConnection.key()
+    offset: int
+    size: int
+    data: bytes | None = None
+
+    def to_message(self, buf) -> TMessage:
+        data = self.data if self.data is not None else bytes(buf[self.offset : self.offset + self.size])
+        return TMessage(
+            id=self.id,
+            method=self.method,
+            type=self.type,
+            seqid=self.seqid,
+            timestamp=self.timestamp,
+            protocol_type=self.protocol_type,
+            transport_type=self.transport_type,
+            connection=get_connection(self.connection) if self.connection is not None else None,
+            data=data,
+        )
+
+
+@functools.lru_cache(maxsize=4096)
+def get_connection(key: tuple) -> TConnection:
+    """
+    Messages of a connection share one `TConnection` in a worker, as they do in a session.
+    """
+    from_host, from_port, listen_host, listen_port = key
+    return TConnection(from_host=from_host, from_port=from_port, listen_host=listen_host, listen_port=listen_port)
+
+
+class PayloadArena:
+    """
+    A shared memory segment of `slots` slots of `slot_size` bytes, each holding the payloads of
+    messages being transformed, so workers map them instead of unpickling them.
+    The owner acquires a slot per batch of messages and releases it once the batch is done.
+    """
+
+    def __init__(self, slots: int, slot_size: int = 4 * 1024 * 1024) -> None:
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(create=True, size=max(slots, 1) * slot_size)
+        self.name = self.shm.name
+        self.free = collections.deque(range(max(slots, 1)))
+        self.lock = threading.Lock()
+        self.inline_size = 0  # payloads that were carried inline
+
+    def acquire(self) -> int | None:
+        with self.lock:
+            return self.free.popleft() if self.free else None
+
+    def release(self, slot: int | None):
+        if slot is not None:
+            with self.lock:
+                self.free.append(slot)
+
+    def pack(self, messages: list[TMessage], slot: int | None) -> list[TMessageDescriptor]:
+        """
+        Copy the payloads of `messages` into `slot`, those that do not fit (or all without a slot)
+        are carried inline.
+        """
+        descriptors = []
+        offset = end = 0
+        if slot is not None:
+            offset = slot * self.slot_size
+            end = offset + self.slot_size
+        buf = self.shm.buf
+        for message in messages:
+            size = len(message.data)
+            inline = None
+            if offset + size <= end:
+                buf[offset : offset + size] = message.data
+            else:
+                inline = message.data
+                self.inline_size += 1
+            connection = message.connection.key() if message.connection is not None else None
+            descriptors.append(
+                TMessageDescriptor(
+                    message.id,
+                    message.method,
+                    message.type,
+                    message.seqid,
+                    message.timestamp,
+                    message.protocol_type,
+                    message.transport_type,
+                    connection,
+                    offset,
+                    size,
+                    inline,
+                )
+            )
+            if inline is None:
+                offset += size
+        return descriptors
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+# arenas mapped by a worker process, kept for its lifetime
+attached_arenas: dict[str, shared_memory.SharedMemory] = {}
+
+
+def load_messages(name: str, descriptors: list[TMessageDescriptor]) -> list[TMessage]:
+    shm = attached_arenas.get(name)
+    if shm is None:
+        shm = attached_arenas[name] = shared_memory.SharedMemory(name=name)
+    return [descriptor.to_message(shm.buf) for descriptor in descriptors]